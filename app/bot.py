@@ -1,13 +1,24 @@
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from aiogram import Bot, Dispatcher
 from aiogram.utils.executor import Executor
 
 from app import settings
+from app.database.chroma_db_service import get_vector_store, get_embeddings, collect_garbage, clear_vector_index
+from app.database.sql_db_service import init_db
 from app.internals.bot_logic.bot_memory import LRUMutableMemoryStorage
 from app.internals.chat.chat_models import load_chat_model
+from app.internals.chat.prompt_templates import warm_up_templates
+from app.internals.custom_models.blip_captions_model import get_blip_captioner
 from app.utils.tg_bot_utils import session_auto_ended
 
+logger = logging.getLogger(__name__)
+
 tg_bot = Bot(token=settings.config.TG_BOT_TOKEN)
 memory = LRUMutableMemoryStorage(max_entries=settings.config.bot_max_users_memory,
                                  non_copy_keys=['messaging_lock', 'generation_task'],
@@ -16,13 +27,96 @@ dp = Dispatcher(tg_bot, storage=memory)
 # dp.setup_middleware(LoggingMiddleware())
 
 thread_pool = ThreadPoolExecutor(max_workers=None, thread_name_prefix='gpt_tg_bot')
+_process_pool = ProcessPoolExecutor(max_workers=settings.config.documents.ingestion_workers)  # documents parsing
+_process_pool_lock = threading.Lock()
+vector_index_ready = asyncio.Event()  # set after the startup cleanup, uploads wait for it, polling doesn't
+
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Current documents parsing pool, it is replaced if a worker dies"""
+    return _process_pool
+
+
+def replace_broken_process_pool(broken_pool: ProcessPoolExecutor) -> ProcessPoolExecutor:
+    """
+    A pool with a dead worker (OOM-kill, crash in a parser) rejects all tasks, so it is replaced with a new one.
+    Only the first caller that saw the broken pool replaces it, others get the new pool.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is broken_pool:
+            broken_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = ProcessPoolExecutor(max_workers=settings.config.documents.ingestion_workers)
+            logger.warning("Documents parsing pool was broken by a dead worker, a new pool is started")
+        return _process_pool
+
 
 small_context_model = load_chat_model(settings.config.models.small_context)
 long_context_model = load_chat_model(settings.config.models.long_context)
 superior_model = load_chat_model(settings.config.models.superior)
 
 
+def warm_up():
+    """Loads tokenizers, clients and models in background, so polling starts without waiting for them"""
+    warm_up_steps = [
+        ('tokenizers', lambda: [model.tokenizer for model in [small_context_model, long_context_model, superior_model]]),
+        ('prompt templates', lambda: warm_up_templates(small_context_model, long_context_model, superior_model)),
+        ('vector store', get_vector_store),
+        ('embeddings', get_embeddings),
+        ('blip', get_blip_captioner)
+    ]
+    for name, step in warm_up_steps:
+        start_time = time.time()
+        try:
+            step()
+            logger.info(f"Warm-up of {name} finished in {time.time() - start_time:.2f}s")
+        except Exception as e:
+            logger.warning(f"Warm-up of {name} failed, it will be retried on first use: {e}")
+
+
+async def prepare_vector_index():
+    """Clears vectors left by the previous run in background, a failure doesn't block uploads forever"""
+    try:
+        if settings.config.vector_store.clear_on_startup:
+            await asyncio.get_event_loop().run_in_executor(thread_pool, clear_vector_index)
+    except Exception as e:
+        logger.warning(f"Vector index cleanup failed: {e}")
+    finally:
+        vector_index_ready.set()
+
+
+async def vectors_garbage_collection():
+    """Periodically removes vectors of reset and evicted sessions from the shared index"""
+    while True:
+        await asyncio.sleep(settings.config.vector_store.gc_interval)
+        try:
+            await asyncio.get_event_loop().run_in_executor(thread_pool, collect_garbage)
+        except Exception as e:
+            logger.warning(f"Vectors garbage collection failed, will be retried: {e}")
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    from app.internals.function_calling.web_fetcher import get_web_fetcher
+
+    await get_web_fetcher().close()
+
+
+async def on_startup(dispatcher: Dispatcher):
+    from app.internals.function_calling.ingestion_pipeline import get_queues_manager
+
+    init_db()
+    # Workers and queues manager are forked before any task is submitted to the thread pool,
+    # so no pool thread can hold a lock (e.g. of logging) at the moment of fork
+    await asyncio.get_event_loop().run_in_executor(get_process_pool(), os.getpid)
+    get_queues_manager()
+    asyncio.create_task(prepare_vector_index())
+    asyncio.get_event_loop().run_in_executor(thread_pool, warm_up)
+    asyncio.create_task(vectors_garbage_collection())
+
+
 def run_pooling():
     executor = Executor(dispatcher=dp)
+    executor.on_startup(on_startup)
+    executor.on_shutdown(on_shutdown)
     executor.start_polling(dp)
-
@@ -1,39 +1,184 @@
+import functools
 import logging
-from typing import List
-
-import chromadb
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.schema import Document
-from langchain.vectorstores import Chroma
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import List, Tuple, TYPE_CHECKING
 
 from app import settings
+from app.database.embeddings_cache import EmbeddingsCache
+from app.database.vector_stores import BaseVectorStore, ChromaVectorStore, LocalVectorStore
+
+if TYPE_CHECKING:
+    from langchain.embeddings import OpenAIEmbeddings
+    from langchain.schema import Document
 
 logger = logging.getLogger(__name__)
 
-# host needs to be changed in prod to chroma_server (as in docker-compose.yml), for local test - localhost
-chroma_client: chromadb.HttpClient = chromadb.HttpClient(host='chroma_server', port="8000")
-chroma_client.heartbeat()
+VECTOR_STORES = ['chroma', 'local']
+
+_removal_pending_users = set()  # users whose vectors will be removed by the next garbage collection
+_writing_users = Counter()  # user id -> writes of vectors in progress, the garbage collection skips these users
+_deleting_users = set()  # users whose vectors are being removed, writes wait for the removal
+_removal_condition = threading.Condition()
+
+
+@functools.lru_cache(maxsize=1)
+def get_vector_store() -> BaseVectorStore:
+    config = settings.config.vector_store
+    assert config.backend in VECTOR_STORES, f"{config.backend} is not supported vector store"
+    if config.backend == 'local':
+        vector_store = LocalVectorStore(dir_path=config.local_dir, max_loaded_users=settings.config.bot_max_users_memory)
+    else:
+        # host needs to be changed in prod to chroma_server (as in docker-compose.yml), for local test - localhost
+        vector_store = ChromaVectorStore(shards=config.shards, host='chroma_server', port='8000')
+    logger.info(f"Vector store initialized: {config.backend}")
+    return vector_store
+
+
+@functools.lru_cache(maxsize=1)
+def get_embeddings() -> 'OpenAIEmbeddings':
+    from langchain.embeddings import OpenAIEmbeddings
+
+    return OpenAIEmbeddings(openai_api_key=settings.config.OPENAI_KEY,
+                            model=settings.config.embeddings_model.model_name,
+                            embedding_ctx_length=settings.config.embeddings_model.embedding_ctx_length,
+                            max_retries=settings.config.embeddings_model.max_retries)
+
+
+@functools.lru_cache(maxsize=1)
+def get_embeddings_cache() -> EmbeddingsCache:
+    return EmbeddingsCache(cache_dir=settings.config.embeddings_model.cache_dir,
+                           model_name=settings.config.embeddings_model.model_name,
+                           dtype=settings.config.embeddings_model.cache_dtype,
+                           max_entries=settings.config.embeddings_model.cache_max_entries)
+
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    """Embeds texts, only cache misses are sent to the embeddings API"""
+    embeddings_cache = get_embeddings_cache()
+    vectors, missed = embeddings_cache.get_many(texts)
+    if missed:
+        missed_texts = [texts[i] for i in missed]
+        missed_vectors = get_embeddings().embed_documents(missed_texts)
+        embeddings_cache.put_many(missed_texts, missed_vectors)
+        for i, vector in zip(missed, missed_vectors):
+            vectors[i] = vector
+    logger.debug(f"Embedded {len(texts)} texts, cache misses: {len(missed)}")
+    return vectors
+
+
+def add_embedded_documents(user_id: int, documents: List['Document'], embeddings: List[List[float]]):
+    """Inserts user documents with already computed embeddings"""
+    get_vector_store().add(user_id,
+                           embeddings=embeddings,
+                           documents=[document.page_content for document in documents],
+                           metadatas=[document.metadata for document in documents])
+
+
+def add_documents(user_id: int, documents: List['Document']):
+    embeddings = embed_texts([document.page_content for document in documents])
+    return add_embedded_documents(user_id, documents, embeddings)
+
+
+def search_documents(user_id: int, file_id: str, queries_embeddings: List[List[float]],
+                     k: int) -> List[List[Tuple[str, dict]]]:
+    """Similarity search in one user document for several queries at once, returns texts with metadata"""
+    return get_vector_store().query(user_id, file_id, queries_embeddings, k)
+
+
+def copy_document_vectors(source_user_id: int, user_id: int, file_id: str) -> int:
+    """
+    Attaches already indexed document from another (or the same) user without parsing and embedding.
+    Returns count of attached chunks, 0 if the source user doesn't have the document anymore.
+    """
+    from app.internals.function_calling.hybrid_search import copy_keyword_index
+
+    with user_vectors_write(user_id):
+        vector_store = get_vector_store()
+        attached_count = vector_store.count(user_id, file_id)
+        if attached_count:  # already attached in the current session
+            return attached_count
+
+        embeddings, documents, metadatas = vector_store.get(source_user_id, file_id)
+        if not documents:
+            return 0
+
+        vector_store.add(user_id, embeddings=embeddings, documents=documents, metadatas=metadatas)
+        copy_keyword_index(source_user_id, user_id, file_id)
+    logger.debug(f"Document '{file_id}' vectors copied from user '{source_user_id}' to '{user_id}'")
+    return len(documents)
+
+
+def schedule_user_vectors_removal(user_id: int):
+    """Called when a session is reset or evicted from memory, vectors are removed by collect_garbage"""
+    with _removal_condition:
+        _removal_pending_users.add(user_id)
+
+
+def begin_user_vectors_write(user_id: int):
+    """
+    Called before user vectors are added: cancels the pending removal and waits if the removal is running,
+    so the garbage collection doesn't remove fresh vectors. Blocking, must be called in a pool thread.
+    """
+    with _removal_condition:
+        _removal_pending_users.discard(user_id)
+        _writing_users[user_id] += 1
+        _removal_condition.wait_for(lambda: user_id not in _deleting_users)
+
+
+def end_user_vectors_write(user_id: int):
+    with _removal_condition:
+        _writing_users[user_id] -= 1
+        if _writing_users[user_id] <= 0:
+            del _writing_users[user_id]
+
 
-embeddings = OpenAIEmbeddings(openai_api_key=settings.config.OPENAI_KEY,
-                              model=settings.config.embeddings_model.model_name,
-                              embedding_ctx_length=settings.config.embeddings_model.embedding_ctx_length,
-                              max_retries=settings.config.embeddings_model.max_retries)
+@contextmanager
+def user_vectors_write(user_id: int):
+    begin_user_vectors_write(user_id)
+    try:
+        yield
+    finally:
+        end_user_vectors_write(user_id)
 
 
-def delete_if_exists(collection_name) -> bool:
-    collections = set([x.name for x in chroma_client.list_collections()])
-    if collection_name in collections:
-        chroma_client.delete_collection(collection_name)
-        logger.debug(f"Chroma collection '{collection_name}' deleted.")
-        return True
-    return False
+def collect_garbage() -> int:
+    from app.internals.function_calling.hybrid_search import delete_keyword_indexes
 
+    with _removal_condition:
+        users = list(_removal_pending_users)
+    vector_store = get_vector_store()
+    removed_count = 0
+    for user_id in users:
+        # Re-checked per user, the removal could be cancelled by a new upload since the snapshot
+        with _removal_condition:
+            if user_id not in _removal_pending_users or user_id in _writing_users:
+                continue
+            _removal_pending_users.discard(user_id)
+            _deleting_users.add(user_id)
+        try:
+            vector_store.delete_user(user_id)
+            delete_keyword_indexes(user_id)
+            removed_count += 1
+        except Exception:
+            with _removal_condition:  # retried by the next collection, unless the user started a new upload
+                if user_id not in _writing_users:
+                    _removal_pending_users.add(user_id)
+            raise
+        finally:
+            with _removal_condition:
+                _deleting_users.discard(user_id)
+                _removal_condition.notify_all()
+    if removed_count:
+        logger.info(f"Vectors of {removed_count} ended sessions removed")
+    return removed_count
 
-def create_vector_store(user_id: int) -> Chroma:
-    collection_name = str(user_id)
-    delete_if_exists(collection_name)
-    return Chroma(collection_name=collection_name, embedding_function=embeddings, client=chroma_client)
 
+def clear_vector_index():
+    """Sessions are kept in memory, so after restart no one can reach previously indexed vectors"""
+    from app.internals.function_calling.hybrid_search import clear_keyword_indexes
 
-def add_documents(vectorstore: Chroma, documents: List[Document]):
-    return vectorstore.add_documents(documents=documents)
+    get_vector_store().clear()
+    clear_keyword_indexes()
+    logger.info("Vector index cleared")
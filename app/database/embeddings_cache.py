@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import unicodedata
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+KEY_SIZE = 20  # sha1 digest
+SPACES_REGEXP = re.compile(r'\s+')
+
+
+def normalize_text(text: str) -> str:
+    return SPACES_REGEXP.sub(' ', unicodedata.normalize('NFC', text)).strip()
+
+
+class EmbeddingsCache:
+    """
+    Content-addressed embeddings cache, keyed by (embedding model, normalized text hash).
+
+    Stored on disk as two append-only files per model:
+    - keys.bin: sha1 digests, KEY_SIZE bytes per row
+    - vectors.bin: vectors in 'dtype', one row per key
+    - meta.json: vectors dimension
+    Row order is the same in both files, so the index is rebuilt from keys.bin on start.
+    """
+
+    def __init__(self, cache_dir: str, model_name: str, dtype: str = 'float16', max_entries: int = 1_000_000):
+        self.model_name = model_name
+        self.dtype = np.dtype(dtype)
+        self.max_entries = max_entries
+        self.dir_path = os.path.join(cache_dir, model_name)
+        self.keys_path = os.path.join(self.dir_path, 'keys.bin')
+        self.vectors_path = os.path.join(self.dir_path, 'vectors.bin')
+        self.meta_path = os.path.join(self.dir_path, 'meta.json')
+
+        self.dim: Optional[int] = None
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+        self.saved_requests = 0  # embedding requests avoided because the whole batch was cached
+        self._vectors: Optional[np.memmap] = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.sha1(f"{self.model_name}\0{normalize_text(text)}".encode('utf8')).digest()
+
+    def _load(self):
+        os.makedirs(self.dir_path, exist_ok=True)
+        if not os.path.exists(self.meta_path):
+            return
+        with open(self.meta_path) as file:
+            self.dim = json.load(file)['dim']
+        keys = b''
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, 'rb') as file:
+                keys = file.read()
+        row_size = self.dim * self.dtype.itemsize
+        vectors_count = os.path.getsize(self.vectors_path) // row_size if os.path.exists(self.vectors_path) else 0
+        rows_count = min(len(keys) // KEY_SIZE, vectors_count)
+        # Drops partial keys and vectors without keys left by an interrupted write, so appends stay aligned
+        if os.path.exists(self.keys_path):
+            os.truncate(self.keys_path, rows_count * KEY_SIZE)
+        if os.path.exists(self.vectors_path):
+            os.truncate(self.vectors_path, rows_count * row_size)
+        self.index = {keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]: i for i in range(rows_count)}
+        self._remap()
+        logger.info(f"Embeddings cache loaded for '{self.model_name}': {rows_count} entries, dim {self.dim}")
+
+    def _remap(self):
+        rows_count = len(self.index)
+        self._vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode='r', shape=(rows_count, self.dim)) \
+            if rows_count > 0 else None
+
+    def get_many(self, texts: List[str]) -> Tuple[List[Optional[List[float]]], List[int]]:
+        """Returns vectors (None for misses) and indices of missed texts"""
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            rows = [self.index.get(key) for key in keys]
+            missed = [i for i, row in enumerate(rows) if row is None]
+            found = [(i, row) for i, row in enumerate(rows) if row is not None]
+            vectors: List[Optional[List[float]]] = [None] * len(texts)
+            if found:
+                found_vectors = np.asarray(self._vectors[[row for _, row in found]], dtype=np.float32)
+                for (i, _), vector in zip(found, found_vectors):
+                    vectors[i] = vector.tolist()
+            self.hits += len(found)
+            self.misses += len(missed)
+            if texts and not missed:
+                self.saved_requests += 1
+        return vectors, missed
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]):
+        with self._lock:
+            new_keys, new_vectors = {}, []
+            for text, vector in zip(texts, vectors):
+                key = self._key(text)
+                if key in self.index or key in new_keys:
+                    continue
+                if len(self.index) + len(new_keys) >= self.max_entries:
+                    logger.warning(f"Embeddings cache for '{self.model_name}' is full ({self.max_entries} entries)")
+                    break
+                new_keys[key] = None
+                new_vectors.append(vector)
+            if not new_keys:
+                return
+
+            new_vectors = np.asarray(new_vectors, dtype=self.dtype)
+            if self.dim is None:
+                self.dim = new_vectors.shape[1]
+                with open(self.meta_path, 'w') as file:
+                    json.dump({'dim': self.dim}, file)
+            with open(self.vectors_path, 'ab') as file:
+                file.write(new_vectors.tobytes())
+            with open(self.keys_path, 'ab') as file:  # keys are written last, so a crash can't index missing rows
+                file.write(b''.join(new_keys))
+            for key in new_keys:
+                self.index[key] = len(self.index)
+            self._remap()
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests_count = self.hits + self.misses
+            return {
+                'entries': len(self.index),
+                'size_mb': round(len(self.index) * ((self.dim or 0) * self.dtype.itemsize + KEY_SIZE) / 1024 ** 2, 2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests_count, 3) if requests_count else 0.0,
+                'saved_requests': self.saved_requests
+            }
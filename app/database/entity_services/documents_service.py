@@ -0,0 +1,39 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.database.sql_db_service import DocumentEntity
+
+logger = logging.getLogger(__name__)
+
+
+def get_document(session: Session, file_unique_id: str) -> DocumentEntity:
+    return session.get(DocumentEntity, file_unique_id)
+
+
+def register_document(session: Session, file_unique_id: str, file_name: str,
+                      summary: str, chunks_count: int, user_id: int) -> DocumentEntity:
+    """If the same document was registered concurrently by another upload, the existing row is reused"""
+    document = DocumentEntity(file_unique_id=file_unique_id,
+                              file_name=file_name,
+                              summary=summary,
+                              chunks_count=chunks_count,
+                              created_at=datetime.now(),
+                              last_user_id=user_id)
+    try:
+        with session.begin_nested():  # only the savepoint is rolled back on conflict
+            session.add(document)
+    except IntegrityError:
+        document = get_document(session, file_unique_id)
+        register_document_reuse(session, document, user_id)
+        logger.info(f"Document '{file_unique_id}' was registered concurrently, reused by user '{user_id}'")
+        return document
+    logger.info(f"New document '{file_unique_id}' registered by user '{user_id}', chunks: {chunks_count}")
+    return document
+
+
+def register_document_reuse(session: Session, document: DocumentEntity, user_id: int):
+    document.uploads_count += 1
+    document.last_user_id = user_id  # the latest session most likely still has the vectors
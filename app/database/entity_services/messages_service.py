@@ -77,3 +77,18 @@ def get_avg_messages_by_user(session: Session) -> float:
                 .subquery())
     average_query = session.query(func.avg(subquery.c.total_messages).label('average_messages')).scalar()
     return average_query
+
+
+def get_prompt_cache_stats(session: Session) -> dict:
+    """Week share of prompt tokens served from the provider's prompt cache"""
+    last_week = datetime.now() - timedelta(weeks=1)
+    prompt_tokens, cached_tokens = (session.query(func.sum(MessageEntity.prompt_tokens),
+                                                  func.sum(MessageEntity.cached_tokens))
+                                    .filter(MessageEntity.executed_at >= last_week)
+                                    .one())
+    prompt_tokens, cached_tokens = prompt_tokens or 0, cached_tokens or 0
+    return {
+        'prompt_tokens': prompt_tokens,
+        'cached_tokens': cached_tokens,
+        'hit_rate': round(cached_tokens / prompt_tokens, 3) if prompt_tokens else 0.0
+    }
@@ -2,7 +2,8 @@ import enum
 import inspect
 import typing
 
-from sqlalchemy import Column, String, DateTime, Integer, ForeignKey, Enum, Boolean, create_engine, Table, BigInteger
+from sqlalchemy import Column, String, DateTime, Integer, ForeignKey, Enum, Boolean, create_engine, Table, BigInteger, \
+    inspect as sql_inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import sessionmaker
@@ -148,6 +149,7 @@ class MessageEntity(Base):
     personality = Column(String(50), nullable=False)
 
     prompt_tokens = Column(Integer, default=0, nullable=True)
+    cached_tokens = Column(Integer, default=0, nullable=True)  # part of prompt tokens served from the prompt cache
     completion_tokens = Column(Integer, default=0, nullable=False)
     total_tokens = Column(Integer, default=0, nullable=False)
     history_size = Column(Integer, default=1, nullable=False)
@@ -162,6 +164,20 @@ class MessageEntity(Base):
     reaction = Column(Enum(Reaction), default=None, nullable=True)
 
 
+class DocumentEntity(Base):
+    __tablename__ = "documents"
+
+    file_unique_id = Column(String(64), primary_key=True)
+
+    file_name = Column(String(), nullable=False)
+    summary = Column(String(), nullable=False)
+    chunks_count = Column(Integer, nullable=False)
+
+    created_at = Column(DateTime, nullable=False)
+    last_user_id = Column(BigInteger, ForeignKey('users.user_id'), nullable=False)  # whose index has the vectors
+    uploads_count = Column(Integer, default=1, nullable=False)
+
+
 class FailedCommunicationEntity(Base):
     __tablename__ = "failed_communications"
 
@@ -173,7 +189,24 @@ class FailedCommunicationEntity(Base):
     traceback = Column(String, nullable=False)
 
 
-Base.metadata.create_all(engine)
+def _add_missing_columns():
+    """create_all doesn't alter existing tables, so new nullable columns are added here"""
+    inspector = sql_inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns and column.nullable:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+
+def init_db():
+    # Called on bot startup instead of module import, it needs a round trip to the DB server
+    Base.metadata.create_all(engine)
+    _add_missing_columns()
 
 
 def with_session(fn: typing.Callable):
@@ -0,0 +1,113 @@
+"""
+Query latency and ingest throughput benchmark of vector store backends.
+
+Usage: python -m app.database.vector_store_benchmark [--chroma-host localhost] [--chunks 500] [--files 4]
+
+Random unit vectors are used instead of real embeddings (search cost does not depend on the values),
+embedding requests are not included. Chroma is skipped if the server is not reachable.
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from statistics import median
+
+import numpy as np
+
+from app.database.vector_stores import BaseVectorStore, ChromaVectorStore, LocalVectorStore
+
+DIM = 1536  # text-embedding-ada-002
+USERS = 8
+QUERIES = 200
+BATCH_SIZE = 64
+K = 8
+
+
+def _make_corpus(chunks_count: int, files_count: int):
+    vectors = np.random.randn(chunks_count, DIM).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    documents = [f"chunk {i} " * 50 for i in range(chunks_count)]
+    metadatas = [{'file_id': f"file_{i % files_count}", 'file_name': f"file_{i % files_count}.pdf", 'chunk_index': i}
+                 for i in range(chunks_count)]
+    return vectors, documents, metadatas
+
+
+def _benchmark(name: str, vector_store: BaseVectorStore, chunks_count: int, files_count: int) -> dict:
+    vectors, documents, metadatas = _make_corpus(chunks_count, files_count)
+
+    ingest_start = time.time()
+    for user_id in range(USERS):
+        for i in range(0, chunks_count, BATCH_SIZE):
+            vector_store.add(user_id, vectors[i:i + BATCH_SIZE].tolist(), documents[i:i + BATCH_SIZE],
+                             metadatas[i:i + BATCH_SIZE])
+    ingest_time = time.time() - ingest_start
+
+    queries = np.random.randn(QUERIES, DIM).astype(np.float32)
+    latencies = []
+    for i, query in enumerate(queries):
+        query = query.tolist()
+        start = time.time()
+        vector_store.query(i % USERS, f"file_{i % files_count}", [query], K)
+        latencies.append((time.time() - start) * 1000)
+
+    # exact search on the local backend is the reference for recall
+    recall = None
+    if isinstance(vector_store, ChromaVectorStore):
+        recall = _recall(vector_store, vectors, metadatas, files_count)
+
+    vector_store.clear()
+    latencies.sort()
+    return {'backend': name,
+            'ingest_chunks_s': USERS * chunks_count / ingest_time,
+            'median_ms': median(latencies),
+            'p95_ms': latencies[int(len(latencies) * 0.95)],
+            'recall': recall}
+
+
+def _recall(vector_store: BaseVectorStore, vectors: np.ndarray, metadatas: list, files_count: int) -> float:
+    file_ids = np.array([metadata['file_id'] for metadata in metadatas])
+    hits = total = 0
+    for i in range(50):
+        file_id = f"file_{i % files_count}"
+        query = np.random.randn(DIM).astype(np.float32)
+        rows = np.flatnonzero(file_ids == file_id)
+        expected = set(rows[np.argsort(-(vectors[rows] @ query))[:K]].tolist())
+        found = set(metadata['chunk_index'] for _, metadata in vector_store.query(0, file_id, [query.tolist()], K)[0])
+        hits += len(expected & found)
+        total += len(expected)
+    return hits / total
+
+
+def run_benchmark(chroma_host: str, chunks_count: int, files_count: int):
+    results = []
+
+    local_dir = tempfile.mkdtemp(prefix='vector_store_')
+    try:
+        results.append(_benchmark('local', LocalVectorStore(local_dir, max_loaded_users=USERS),
+                                  chunks_count, files_count))
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+    try:
+        chroma_store = ChromaVectorStore(shards=USERS, host=chroma_host, port='8000')
+    except Exception as e:
+        print(f"Chroma skipped, server is not reachable: {e}")
+    else:
+        chroma_store.clear()
+        results.append(_benchmark('chroma', chroma_store, chunks_count, files_count))
+
+    print(f"{USERS} users x {chunks_count} chunks in {files_count} files, dim {DIM}, k {K}")
+    print(f"{'backend':<8} {'ingest chunks/s':>16} {'median ms':>10} {'p95 ms':>8} {'recall':>7}")
+    for result in results:
+        recall = f"{result['recall']:.3f}" if result['recall'] is not None else 'exact'
+        print(f"{result['backend']:<8} {result['ingest_chunks_s']:>16.0f} {result['median_ms']:>10.2f} "
+              f"{result['p95_ms']:>8.2f} {recall:>7}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chroma-host', default='localhost')
+    parser.add_argument('--chunks', type=int, default=500, help='chunks per user')
+    parser.add_argument('--files', type=int, default=4, help='files per user')
+    args = parser.parse_args()
+    run_benchmark(args.chroma_host, args.chunks, args.files)
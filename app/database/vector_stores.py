@@ -0,0 +1,264 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Tuple, Optional, TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from chromadb.api.models.Collection import Collection
+
+logger = logging.getLogger(__name__)
+
+
+class BaseVectorStore(ABC):
+    """Vectors of user documents, every query is limited to a single user and a single file"""
+
+    @abstractmethod
+    def add(self, user_id: int, embeddings: List[List[float]], documents: List[str], metadatas: List[dict]):
+        pass
+
+    @abstractmethod
+    def query(self, user_id: int, file_id: str, embeddings: List[List[float]], k: int) -> List[List[Tuple[str, dict]]]:
+        """Batched search, returns found texts with metadata for every query embedding"""
+        pass
+
+    @abstractmethod
+    def get(self, user_id: int, file_id: str) -> Tuple[List[List[float]], List[str], List[dict]]:
+        pass
+
+    @abstractmethod
+    def count(self, user_id: int, file_id: str) -> int:
+        pass
+
+    @abstractmethod
+    def delete_user(self, user_id: int):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+
+class ChromaVectorStore(BaseVectorStore):
+    """
+    Chroma HTTP server backend.
+    All users share 'shards' collections, user vectors are partitioned by 'user_id' metadata.
+    """
+
+    COLLECTION_NAME_FORMAT = "documents_{shard}"
+
+    def __init__(self, shards: int, host: str = 'chroma_server', port: str = '8000'):
+        import chromadb
+
+        self.shards = shards
+        self.client = chromadb.HttpClient(host=host, port=port)
+        self.client.heartbeat()
+        self._collections = {}
+        self._collections_lock = threading.Lock()
+
+    def _collection(self, user_id: int) -> 'Collection':
+        shard = user_id % self.shards
+        with self._collections_lock:
+            if shard not in self._collections:  # created on first upload to the shard, not on every /start
+                self._collections[shard] = self.client.get_or_create_collection(
+                    self.COLLECTION_NAME_FORMAT.format(shard=shard), embedding_function=None)
+            return self._collections[shard]
+
+    @staticmethod
+    def _filter(user_id: int, file_id: str = None) -> dict:
+        if file_id is None:
+            return {'user_id': user_id}
+        return {'$and': [{'user_id': user_id}, {'file_id': file_id}]}
+
+    def add(self, user_id: int, embeddings: List[List[float]], documents: List[str], metadatas: List[dict]):
+        self._collection(user_id).add(ids=[str(uuid.uuid1()) for _ in documents],
+                                      embeddings=embeddings,
+                                      metadatas=[{**metadata, 'user_id': user_id} for metadata in metadatas],
+                                      documents=documents)
+
+    def query(self, user_id: int, file_id: str, embeddings: List[List[float]], k: int) -> List[List[Tuple[str, dict]]]:
+        found = self._collection(user_id).query(query_embeddings=embeddings,
+                                                n_results=k,
+                                                where=self._filter(user_id, file_id),
+                                                include=['documents', 'metadatas'])
+        return [list(zip(documents, metadatas)) for documents, metadatas in zip(found['documents'], found['metadatas'])]
+
+    def get(self, user_id: int, file_id: str) -> Tuple[List[List[float]], List[str], List[dict]]:
+        found = self._collection(user_id).get(where=self._filter(user_id, file_id),
+                                              include=['embeddings', 'documents', 'metadatas'])
+        return found['embeddings'], found['documents'], found['metadatas']
+
+    def count(self, user_id: int, file_id: str) -> int:
+        return len(self._collection(user_id).get(where=self._filter(user_id, file_id), include=[])['ids'])
+
+    def delete_user(self, user_id: int):
+        self._collection(user_id).delete(where=self._filter(user_id))
+
+    def clear(self):
+        existing = set([x.name for x in self.client.list_collections()])
+        with self._collections_lock:
+            for shard in range(self.shards):
+                collection_name = self.COLLECTION_NAME_FORMAT.format(shard=shard)
+                if collection_name in existing:
+                    self.client.delete_collection(collection_name)
+            self._collections.clear()
+
+
+class _UserIndex:
+    """
+    Vectors of a single user, stored in the user directory:
+    - vectors.bin: normalized float32 vectors, one row per chunk
+    - rows.jsonl: chunk text and metadata, one line per row
+    Rows are appended to both files, vectors first, so a crash can't leave a row without a vector.
+    """
+
+    def __init__(self, dir_path: str, dim: Optional[int]):
+        self.dir_path = dir_path
+        self.vectors_path = os.path.join(dir_path, 'vectors.bin')
+        self.rows_path = os.path.join(dir_path, 'rows.jsonl')
+        self.dim = dim
+        self.documents: List[str] = []
+        self.metadatas: List[dict] = []
+        self.file_ids = np.array([], dtype=object)
+        self.vectors: Optional[np.memmap] = None
+        self._load()
+
+    def _load(self):
+        if self.dim is None:
+            return
+        # A missing file (crash between the two appends of the first rows) is the same as an empty one
+        vectors_count = os.path.getsize(self.vectors_path) // (self.dim * 4) if os.path.exists(self.vectors_path) else 0
+        valid_size = 0  # bytes of complete rows, the rest is left by an interrupted write
+        if os.path.exists(self.rows_path):
+            with open(self.rows_path, 'rb') as file:
+                for line in file:
+                    if len(self.documents) == vectors_count or not line.endswith(b'\n'):
+                        break
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        break
+                    self.documents.append(row['document'])
+                    self.metadatas.append(row['metadata'])
+                    valid_size += len(line)
+        # Both files are cut to min(complete rows, complete vectors), so the next appends stay aligned
+        for path, size in [(self.rows_path, valid_size), (self.vectors_path, len(self.documents) * self.dim * 4)]:
+            if os.path.exists(path):
+                os.truncate(path, size)
+        self._remap()
+
+    def _remap(self):
+        self.file_ids = np.array([metadata.get('file_id') for metadata in self.metadatas], dtype=object)
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(len(self.documents), self.dim)) \
+            if self.documents else None
+
+    def add(self, vectors: np.ndarray, documents: List[str], metadatas: List[dict]):
+        os.makedirs(self.dir_path, exist_ok=True)
+        with open(self.vectors_path, 'ab') as file:
+            file.write(vectors.astype(np.float32).tobytes())
+        with open(self.rows_path, 'a', encoding='utf8') as file:
+            file.write(''.join(json.dumps({'document': document, 'metadata': metadata}, ensure_ascii=False) + '\n'
+                               for document, metadata in zip(documents, metadatas)))
+        self.documents.extend(documents)
+        self.metadatas.extend(metadatas)
+        self._remap()
+
+    def rows(self, file_id: str) -> np.ndarray:
+        return np.flatnonzero(self.file_ids == file_id)
+
+
+class LocalVectorStore(BaseVectorStore):
+    """
+    In-process backend: exact (brute force) cosine search over a memory-mapped NumPy matrix per user.
+    A user corpus is a few hundred chunks, so a full scan of one file is faster than an HTTP round trip.
+    """
+
+    def __init__(self, dir_path: str, max_loaded_users: int):
+        self.dir_path = dir_path
+        self.meta_path = os.path.join(dir_path, 'meta.json')
+        self.max_loaded_users = max_loaded_users
+        self.dim: Optional[int] = None
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(self.dir_path, exist_ok=True)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as file:
+                self.dim = json.load(file)['dim']
+
+    def _user_index(self, user_id: int) -> _UserIndex:
+        # Called under the lock, loaded indexes are limited like sessions in memory
+        index = self._indexes.get(user_id)
+        if index is None:
+            index = _UserIndex(os.path.join(self.dir_path, str(user_id)), self.dim)
+            self._indexes[user_id] = index
+            if len(self._indexes) > self.max_loaded_users:
+                self._indexes.popitem(last=False)
+        self._indexes.move_to_end(user_id)
+        return index
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def add(self, user_id: int, embeddings: List[List[float]], documents: List[str], metadatas: List[dict]):
+        vectors = self._normalize(np.asarray(embeddings, dtype=np.float32))
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, 'w') as file:
+                    json.dump({'dim': self.dim}, file)
+            index = self._user_index(user_id)
+            index.dim = self.dim
+            index.add(vectors, documents, metadatas)
+
+    def query(self, user_id: int, file_id: str, embeddings: List[List[float]], k: int) -> List[List[Tuple[str, dict]]]:
+        query_vectors = self._normalize(np.asarray(embeddings, dtype=np.float32))
+        with self._lock:
+            index = self._user_index(user_id)
+            rows = index.rows(file_id)
+            if len(rows) == 0:
+                return [[] for _ in embeddings]
+            all_scores = index.vectors[rows] @ query_vectors.T  # one matrix product for all queries
+            found = []
+            for scores in all_scores.T:
+                best_rows = rows
+                if len(rows) > k:
+                    top = np.argpartition(-scores, k)[:k]
+                    best_rows, scores = rows[top], scores[top]
+                best_rows = best_rows[np.argsort(-scores)]
+                found.append([(index.documents[row], index.metadatas[row]) for row in best_rows])
+            return found
+
+    def get(self, user_id: int, file_id: str) -> Tuple[List[List[float]], List[str], List[dict]]:
+        with self._lock:
+            index = self._user_index(user_id)
+            rows = index.rows(file_id)
+            if len(rows) == 0:
+                return [], [], []
+            return index.vectors[rows].tolist(), [index.documents[row] for row in rows], \
+                [index.metadatas[row] for row in rows]
+
+    def count(self, user_id: int, file_id: str) -> int:
+        with self._lock:
+            return len(self._user_index(user_id).rows(file_id))
+
+    def delete_user(self, user_id: int):
+        with self._lock:
+            self._indexes.pop(user_id, None)
+            shutil.rmtree(os.path.join(self.dir_path, str(user_id)), ignore_errors=True)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            for name in os.listdir(self.dir_path):
+                path = os.path.join(self.dir_path, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
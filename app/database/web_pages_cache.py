@@ -0,0 +1,118 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+logger = logging.getLogger(__name__)
+
+TRACKING_PARAMS_PREFIXES = ('utm_', 'fbclid', 'gclid', 'yclid', 'mc_')
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+EVICTION_BATCH_SIZE = 100
+
+
+def normalize_url(url: str) -> str:
+    """Cache key of a page: lowercase scheme and host, no default port, fragment and tracking params, sorted query"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower() or 'http'
+    host = (parts.hostname or '').lower()
+    if parts.port is not None and DEFAULT_PORTS.get(scheme) != parts.port:
+        host = f"{host}:{parts.port}"
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if not k.lower().startswith(TRACKING_PARAMS_PREFIXES))
+    return urlunsplit((scheme, host, parts.path or '/', urlencode(query), ''))
+
+
+class WebPagesCache:
+    """
+    Disk-backed cache of web pages text in SQLite, bounded by total text size.
+    Every entry keeps validators (ETag, Last-Modified) for conditional revalidation,
+    or an error kind for negative caching of pages that can't be fetched.
+    Least recently accessed entries are evicted first.
+    """
+
+    def __init__(self, file_path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                text TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                error TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)")
+        # Kept up to date on every write, so eviction doesn't scan the table
+        self._total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def get(self, url: str) -> Optional[sqlite3.Row]:
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM pages WHERE url = ?", (url,)).fetchone()
+            if row is not None:
+                self._connection.execute("UPDATE pages SET accessed_at = ? WHERE url = ?", (time.time(), url))
+            return row
+
+    def put(self, url: str, text: str, etag: str = None, last_modified: str = None):
+        self._upsert(url, text=text, etag=etag, last_modified=last_modified, error=None)
+
+    def put_error(self, url: str, error: str):
+        self._upsert(url, text=None, etag=None, last_modified=None, error=error)
+
+    def touch(self, url: str):
+        """Page was revalidated (304 Not Modified), it is fresh again"""
+        with self._lock:
+            self._connection.execute("UPDATE pages SET fetched_at = ? WHERE url = ?", (time.time(), url))
+
+    def _upsert(self, url: str, text: Optional[str], etag: Optional[str], last_modified: Optional[str],
+                error: Optional[str]):
+        now = time.time()
+        size = len(text.encode('utf8')) if text else len(url)  # negative entries are bounded too
+        with self._lock:
+            old_row = self._connection.execute("SELECT size FROM pages WHERE url = ?", (url,)).fetchone()
+            self._connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (url, text, etag, last_modified, error, now, now, size))
+            self._total_size += size - (old_row['size'] if old_row is not None else 0)
+            self._evict()
+
+    def _evict(self):
+        evicted = 0
+        while self._total_size > self.max_bytes:
+            rows = self._connection.execute("SELECT url, size FROM pages ORDER BY accessed_at LIMIT ?",
+                                            (EVICTION_BATCH_SIZE,)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                if self._total_size <= self.max_bytes:
+                    break
+                self._connection.execute("DELETE FROM pages WHERE url = ?", (row['url'],))
+                self._total_size -= row['size']
+                evicted += 1
+        if evicted:
+            logger.debug(f"Web pages cache evicted {evicted} pages")
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+            total_size = self._total_size
+        requests_count = self.hits + self.revalidated + self.misses
+        return {
+            'entries': entries,
+            'size_mb': round(total_size / 1024 ** 2, 2),
+            'hits': self.hits,
+            'revalidated': self.revalidated,
+            'misses': self.misses,
+            'hit_rate': round((self.hits + self.revalidated) / requests_count, 3) if requests_count else 0.0
+        }
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from collections import Counter
 from datetime import datetime
@@ -8,17 +9,20 @@ from aiogram.dispatcher import FSMContext
 from sqlalchemy.orm import Session
 
 from app import settings
-from app.bot import dp, tg_bot
+from app.bot import dp, tg_bot, small_context_model, long_context_model, superior_model, thread_pool
+from app.database.chroma_db_service import get_embeddings_cache
 from app.database.entity_services.feedback_service import get_week_feedbacks
 from app.database.sql_db_service import with_session, UserEntity, Role
 from app.database.entity_services.messages_service import get_all_messages, get_avg_hist_size_by_user, \
     get_avg_tokens_by_user, \
-    get_avg_tokens_per_message, get_avg_messages_by_user
+    get_avg_tokens_per_message, get_avg_messages_by_user, get_prompt_cache_stats
 from app.database.entity_services.tokens_service import tokens_barrier, add_new_tokens_package, find_tokens_package
 from app.database.entity_services.users_service import access_check, check_is_admin, get_all_users, \
     get_user_by_id, set_ban_userid, get_users_with_filters
 from app.handlers.exceptions_handler import zero_exception
 from app.internals.bot_logic.fsm_service import reset_user_state, UserState
+from app.internals.chat.generation_scheduler import get_generation_scheduler
+from app.internals.function_calling.web_fetcher import get_web_fetcher
 
 from app.utils.tg_bot_utils import build_menu_markup, format_language_code, build_price_markup
 
@@ -320,6 +324,17 @@ async def status(session: Session,
         filtered_users = get_users_with_filters(session)
         today_new_users = [user for user in all_users if user.joined_at.date() == datetime.today().date()]
         week_new_users = [user for user in all_users if (datetime.today() - user.joined_at).days < 7]
+        # Caches are created lazily and read from disk, not on the event loop
+        loop = asyncio.get_event_loop()
+        embeddings_cache_stats = await loop.run_in_executor(thread_pool, lambda: get_embeddings_cache().stats())
+        web_cache_stats = await loop.run_in_executor(thread_pool, lambda: get_web_fetcher().cache.stats())
+        prompt_cache_stats = get_prompt_cache_stats(session)
+        scheduler_stats = get_generation_scheduler().stats()
+        circuits = ", ".join(f'{model.config.model_name}: {model.circuit_breaker.state}'
+                             for model in [small_context_model, long_context_model, superior_model])
+        tiers_waits = "\n".join(f'Level {level}: avg. {tier["avg_wait"]}s, p95 {tier["p95_wait"]}s '
+                                f'({tier["count"]} requests)'
+                                for level, tier in scheduler_stats['tiers'].items()) or 'No requests yet'
         reply_message = {
             'text': f'<b>Chatbot status</b>\n\n'
                     f'<i>Users:</i>\n\n'
@@ -339,7 +354,25 @@ async def status(session: Session,
                     f'<i>Tokens:</i>\n\n'
                     f'Today total used tokens: {sum([m.total_tokens for m in today_messages])}\n'
                     f'Week avg. user used tokens: {round(get_avg_tokens_by_user(session), 2)}\n'
-                    f'Week avg. message used tokens: {round(get_avg_tokens_per_message(session), 2)}'
+                    f'Week avg. message used tokens: {round(get_avg_tokens_per_message(session), 2)}\n\n'
+                    f'<i>Prompt cache (week):</i>\n\n'
+                    f'Cached prompt tokens: {prompt_cache_stats["cached_tokens"]} '
+                    f'of {prompt_cache_stats["prompt_tokens"]}\n'
+                    f'Hit rate: {round(prompt_cache_stats["hit_rate"] * 100, 1)}%\n\n'
+                    f'<i>Generations queue:</i>\n\n'
+                    f'In flight: {scheduler_stats["in_flight"]}, waiting: {scheduler_stats["waiting"]}\n'
+                    f'{tiers_waits}\n'
+                    f'Models circuits: {circuits}\n\n'
+                    f'<i>Embeddings cache:</i>\n\n'
+                    f'Entries: {embeddings_cache_stats["entries"]} ({embeddings_cache_stats["size_mb"]} MB)\n'
+                    f'Hit rate: {round(embeddings_cache_stats["hit_rate"] * 100, 1)}% '
+                    f'({embeddings_cache_stats["hits"]} hits, {embeddings_cache_stats["misses"]} misses)\n'
+                    f'Saved embedding requests: {embeddings_cache_stats["saved_requests"]}\n\n'
+                    f'<i>Web pages cache:</i>\n\n'
+                    f'Entries: {web_cache_stats["entries"]} ({web_cache_stats["size_mb"]} MB)\n'
+                    f'Hit rate: {round(web_cache_stats["hit_rate"] * 100, 1)}% '
+                    f'({web_cache_stats["hits"]} hits, {web_cache_stats["revalidated"]} revalidated, '
+                    f'{web_cache_stats["misses"]} misses)'
         }
         await message.answer(**reply_message, parse_mode='HTML')
 
@@ -4,15 +4,16 @@ import logging
 import tempfile
 from asyncio import CancelledError
 
-from PIL import Image
 from aiogram import types
 from aiogram.dispatcher import FSMContext
 from aiogram.types import ContentType
 from sqlalchemy.orm import Session
 
 from app import settings
-from app.bot import dp, small_context_model, long_context_model, superior_model, thread_pool
-from app.database.chroma_db_service import add_documents
+from app.bot import dp, small_context_model, long_context_model, superior_model, thread_pool, vector_index_ready
+from app.database.chroma_db_service import copy_document_vectors
+from app.database.entity_services.documents_service import get_document, register_document, \
+    register_document_reuse
 from app.database.entity_services.feedback_service import save_feedback
 from app.database.entity_services.global_messages_service import global_message, get_gmua
 from app.database.entity_services.messages_service import add_message_record, get_last_message, get_message_by_tgid
@@ -24,15 +25,21 @@ from app.handlers.exceptions_handler import zero_exception
 from app.internals.bot_logic.fsm_service import UserState, reset_user_state, switch_to_communication_state
 from app.internals.chat.chat_history import ChatHistory, ChatRole, ChatMessage
 from app.internals.chat.chat_models import TextGenerationResult
-from app.internals.custom_models.blip_captions_model import get_images_captions
+from app.internals.chat.function_responses_policy import compact_stale_function_responses
+from app.internals.chat.generation_scheduler import get_generation_scheduler, hold_generation_slot
+from app.internals.chat.model_router import agenerate_with_failover
+from app.internals.chat.history_summarizer import schedule_history_summary
+from app.internals.chat.prompt_templates import get_personality_template, get_custom_template
+from app.internals.custom_models.blip_captions_model import get_images_captions, decode_image
 from app.internals.function_calling.definitions import build_openai_functions
 from app.internals.function_calling.executors import execute_function_call
-from app.internals.function_calling.files_processor import load_single_document, check_if_extension_supported, \
-    build_document_info, make_summary
+from app.internals.function_calling.files_processor import check_if_extension_supported, build_document_info, \
+    make_summary, SUMMARY_DOCS
+from app.internals.function_calling.ingestion_pipeline import ingest_document
 from app.utils.tg_bot_utils import build_menu_markup, build_specials_markup, format_language_code, \
-    send_response_message, \
-    format_system_prompt, instant_messages_collector, clean_last_message_markup, update_messages_reaction_markup, \
-    send_settings_menu, update_settings_markup, TypingBlock, update_gmua_reaction_markup
+    send_response_message, format_system_prompt_values, format_time_prompt, \
+    instant_messages_collector, clean_last_message_markup, update_messages_reaction_markup, \
+    send_settings_menu, update_settings_markup, TypingBlock, update_gmua_reaction_markup, ProgressMessage
 
 logger = logging.getLogger(__name__)
 
@@ -162,6 +169,36 @@ async def admin_message(session: Session, user: UserEntity,
     await message.answer(**reply_message)
 
 
+def select_chat_model(history: ChatHistory, functions: list, do_superior: bool, tokens_package_config):
+    if do_superior and tokens_package_config.superior_model:
+        return superior_model
+    small_tokens_overflow: bool = small_context_model.count_tokens_overflow(history, functions)[0] == 0
+    if small_tokens_overflow or not tokens_package_config.long_context:
+        return small_context_model
+    return long_context_model
+
+
+def fallback_chat_models(chat_model, tokens_package_config) -> list:
+    """Selected model first, then other models allowed by the package, in ModelsConfig order"""
+    allowed_models = [small_context_model]
+    if tokens_package_config.long_context:
+        allowed_models.append(long_context_model)
+    if tokens_package_config.superior_model:
+        allowed_models.append(superior_model)
+    return [chat_model] + [model for model in allowed_models if model is not chat_model]
+
+
+async def scheduled_generation(chat_model, history: ChatHistory, functions: list, function_call,
+                               user_id: int, tokens_package_config) -> TextGenerationResult:
+    prompt_tokens, _ = await asyncio.get_event_loop().run_in_executor(thread_pool, chat_model.count_prompt_tokens,
+                                                                      history, functions)
+    cost = min(prompt_tokens, chat_model.config.max_context_size) + chat_model.max_gen_tokens
+    async with get_generation_scheduler().slot(user_id, tokens_package_config.level, cost):
+        # Another model answers if the selected one is unavailable, the answered one is in the result's model_config
+        return await agenerate_with_failover(fallback_chat_models(chat_model, tokens_package_config),
+                                             history, functions, function_call)
+
+
 @dp.message_handler(state=UserState.communication, content_types=ContentType.TEXT)
 @zero_exception
 @with_session
@@ -208,120 +245,112 @@ async def communication_answer(session: Session, user: UserEntity,
         if personality is None:
             return
 
-        system_prompt = settings.personalities[personality].context \
-            if personality != 'custom' else current_user_data.get('custom_prompt')
-        system_prompt = format_system_prompt(tg_user, current_user_data, system_prompt)
+        system_template = get_personality_template(personality) \
+            if personality != 'custom' else get_custom_template(current_user_data.get('custom_prompt'))
 
         # Get current chat history
         history: ChatHistory = current_user_data.get('history') or ChatHistory()
-        history.system_message = ChatMessage(role=ChatRole.SYSTEM, text=system_prompt)
+        history.system_message = system_template.build_message(small_context_model,
+                                                               **format_system_prompt_values(tg_user, current_user_data))
+        history.suffix_message = ChatMessage(role=ChatRole.SYSTEM, text=format_time_prompt())
         if add_user_message_to_hist:
             history.add_message(ChatMessage(role=ChatRole.USER, text=message.text))
+        compact_stale_function_responses(history)
 
-        # Main loop
-        async with TypingBlock(message.chat):
-
-            small_tokens_overflow: bool = small_context_model.count_tokens_overflow(history, functions)[0] == 0
-
-            # Model selection
-            if do_superior and tokens_package_config.superior_model:
-                generation_task = asyncio.get_event_loop().run_in_executor(thread_pool,
-                                                                           superior_model.generate_answer,
-                                                                           history,
-                                                                           functions,
-                                                                           function_call)
-            elif small_tokens_overflow or not tokens_package_config.long_context:
-                generation_task = asyncio.get_event_loop().run_in_executor(thread_pool,
-                                                                           small_context_model.generate_answer,
-                                                                           history,
-                                                                           functions,
-                                                                           function_call)
-            else:
-                generation_task = asyncio.get_event_loop().run_in_executor(thread_pool,
-                                                                           long_context_model.generate_answer,
-                                                                           history,
-                                                                           functions,
-                                                                           function_call)
-
-            # Update current generation task
-            await state.update_data({"generation_task": generation_task})
-
-            try:
-                # Execution of generation request in parallel process
-                generation_result: TextGenerationResult = await generation_task
-            except CancelledError:
-                return
+        # Tools loop: each round is a generation, with function calls executed in-process until a text answer
+        max_tool_rounds = settings.config.max_tool_rounds if functions else 0
+        for tool_round in range(max_tool_rounds + 1):
+            # The last round must answer with text
+            round_function_call = function_call if tool_round < max_tool_rounds else "none"
 
-            # Remove current gen task
-            await state.update_data({"generation_task": None})
-
-        # Adding generated message to chat history
-        history.add_message(generation_result.message)
-
-        # Action management (Default message / FunctionCall)
-        if not generation_result.is_function_call:
-            sent_message = await send_response_message(user=user,
-                                                       user_message=message,
-                                                       bot_message=generation_result.message.text,
-                                                       do_reply=instant_messages_buffer_size == 1,
-                                                       add_redo=instant_messages_buffer_size == 1 and not is_image)
-            logger.info(f'AI answer sent to "{tg_user.username}" | "{tg_user.id}",'
-                        f' personality: "{personality}",'
-                        f' model: "{generation_result.model_config.model_name}",'
-                        f' tokens used: {generation_result.total_tokens_usage},'
-                        f' time taken: {generation_result.time_taken}')
-
-        add_message_record(session, tg_user.id,
-                           MessageEntity(tg_message_id=sent_message.message_id if sent_message else None,
-                                         executed_at=datetime.datetime.now(),
-                                         time_taken=generation_result.time_taken,
-                                         model=generation_result.model_config.model_name,
-                                         personality=personality,
-                                         prompt_tokens=generation_result.prompt_tokens_usage,
-                                         completion_tokens=generation_result.completion_tokens_usage,
-                                         total_tokens=generation_result.total_tokens_usage,
-                                         history_size=len(history),
-                                         instant_buffer=instant_messages_buffer_size,
-                                         has_image=is_image,
-                                         has_document=has_document,
-                                         function_call=generation_result.message.name if generation_result.is_function_call else None,
-                                         regenerated=False))
-        left_tokens = tokens_spending(tokens_package,
-                                      generation_result.total_tokens_usage,
-                                      generation_result.model_config)
-
-        if user.settings.enable_tokens_info:
-            await message.reply(settings.messages.tokens.tokens_count[lc].format(
-                prompt_tokens=int(generation_result.prompt_tokens_usage * generation_result.model_config.tokens_scale),
-                completion_tokens=int(generation_result.completion_tokens_usage * generation_result.model_config.tokens_scale),
-                left_tokens=left_tokens,
-            ), parse_mode='HTML')
-
-        # Make function call
-        if generation_result.is_function_call:
             async with TypingBlock(message.chat):
-                await message.reply(settings.messages.external_data[lc])
-                function_response = await asyncio.get_event_loop().run_in_executor(thread_pool,
-                                                                                   execute_function_call,
-                                                                                   user,
-                                                                                   current_user_data,
-                                                                                   generation_result.message)
-
-            # Update chat history and release the lock
-            history.add_message(function_response)
+                # History with function responses can be long, its tokens are counted in the thread pool
+                chat_model = await asyncio.get_event_loop().run_in_executor(thread_pool, select_chat_model, history,
+                                                                            functions, do_superior,
+                                                                            tokens_package_config)
+                # Waits for the user's turn among all users and the model's rate limit,
+                # then the request is sent from the thread pool
+                generation_task = asyncio.ensure_future(scheduled_generation(chat_model, history, functions,
+                                                                             round_function_call, tg_user.id,
+                                                                             tokens_package_config))
+
+                # Update current generation task
+                await state.update_data({"generation_task": generation_task})
+
+                try:
+                    # Execution of generation request in parallel process
+                    generation_result: TextGenerationResult = await generation_task
+                except CancelledError:
+                    return
+
+                # Remove current gen task
+                await state.update_data({"generation_task": None})
+
+            # Adding generated message to chat history
+            history.add_message(generation_result.message)
+
+            # Action management (Default message / FunctionCall)
+            if not generation_result.is_function_call:
+                sent_message = await send_response_message(user=user,
+                                                           user_message=message,
+                                                           bot_message=generation_result.message.text,
+                                                           do_reply=instant_messages_buffer_size == 1,
+                                                           add_redo=instant_messages_buffer_size == 1 and not is_image)
+                logger.info(f'AI answer sent to "{tg_user.username}" | "{tg_user.id}",'
+                            f' personality: "{personality}",'
+                            f' model: "{generation_result.model_config.model_name}",'
+                            f' tokens used: {generation_result.total_tokens_usage},'
+                            f' time taken: {generation_result.time_taken},'
+                            f' tool rounds: {tool_round}')
+
+            # One record per round
+            add_message_record(session, tg_user.id,
+                               MessageEntity(tg_message_id=sent_message.message_id if sent_message else None,
+                                             executed_at=datetime.datetime.now(),
+                                             time_taken=generation_result.time_taken,
+                                             model=generation_result.model_config.model_name,
+                                             personality=personality,
+                                             prompt_tokens=generation_result.prompt_tokens_usage,
+                                             cached_tokens=generation_result.cached_tokens_usage,
+                                             completion_tokens=generation_result.completion_tokens_usage,
+                                             total_tokens=generation_result.total_tokens_usage,
+                                             history_size=len(history),
+                                             instant_buffer=instant_messages_buffer_size,
+                                             has_image=is_image,
+                                             has_document=has_document,
+                                             function_call=generation_result.message.names[:50] if generation_result.is_function_call else None,
+                                             regenerated=False))
+            left_tokens = tokens_spending(tokens_package,
+                                          generation_result.total_tokens_usage,
+                                          generation_result.model_config)
+
+            if user.settings.enable_tokens_info:
+                await message.reply(settings.messages.tokens.tokens_count[lc].format(
+                    prompt_tokens=int(generation_result.prompt_tokens_usage * generation_result.model_config.tokens_scale),
+                    completion_tokens=int(generation_result.completion_tokens_usage * generation_result.model_config.tokens_scale),
+                    left_tokens=left_tokens,
+                ), parse_mode='HTML')
+
+            if not generation_result.is_function_call:
+                break
+
+            # Make function calls, the task is cancelled as a generation if the user state is reset
+            async with TypingBlock(message.chat):
+                if tool_round == 0:
+                    await message.reply(settings.messages.external_data[lc])
+                tools_task = asyncio.ensure_future(execute_function_call(user, current_user_data,
+                                                                         generation_result.message))
+                await state.update_data({"generation_task": tools_task})
+                try:
+                    function_responses = await tools_task
+                except CancelledError:
+                    return
+                await state.update_data({"generation_task": None})
+
+            for function_response in function_responses:
+                history.add_message(function_response)
             await state.update_data({"history": history})
 
-            # Call to get the final response
-            await asyncio.get_event_loop().create_task(communication_answer(message,
-                                                                            state=state,
-                                                                            add_user_message_to_hist=False,
-                                                                            do_superior=do_superior,
-                                                                            function_call="none",
-                                                                            has_document=has_document,
-                                                                            is_image=is_image,
-                                                                            ignore_lock=True))
-            return
-
         # Check tokens in the end and reset the state to menu
         if not await tokens_barrier(session, user):
             await reset_user_state(session, user, state)
@@ -331,12 +360,14 @@ async def communication_answer(session: Session, user: UserEntity,
         if left_tokens / tokens_package_config.tokens < 0.1 and left_tokens > 0 and not settings.config.free_mode:
             await message.answer(settings.messages.tokens.running_out[lc])
 
-        # Remove functions responses to save tokens (not using)
-        # history.remove_function_responses()
+        # Stale functions responses are replaced with stubs on the next turn (see function_responses_policy)
 
         # Update user state with new history
         await state.update_data({"history": history})
 
+        # Fold old messages into the rolling summary in background, if history is too long
+        schedule_history_summary(state, tg_user.id, history, messages_lock)
+
     finally:
         if not ignore_lock and messages_lock.locked():
             messages_lock.release()
@@ -358,15 +389,14 @@ async def photo_answer(message: types.Message, state: FSMContext, *args, **kwarg
         await asyncio.get_event_loop().create_task(communication_answer(message, state=state, is_image=False))
         return
 
-    file_info = await message.bot.get_file(message.photo[-1].file_id)
+    photo = message.photo[-1]
+    file_info = await message.bot.get_file(photo.file_id)
 
-    with tempfile.TemporaryDirectory() as tmp_dir:  # temp dir for future support of many photos
-        result = await message.bot.download_file(file_path=file_info.file_path,
-                                                 destination_dir=tmp_dir)
-        result.close()
-        image = Image.open(result.name).convert('RGB')
+    buffer = await message.bot.download_file(file_path=file_info.file_path)  # BytesIO, no disk I/O
+    image = decode_image(buffer)
 
-    image_caption = get_images_captions(image)[0]
+    captions = await asyncio.get_event_loop().run_in_executor(thread_pool, get_images_captions, image)
+    image_caption = captions[0]
     pers = current_user_data.get('personality')
 
     if pers == 'joker':
@@ -378,7 +408,8 @@ async def photo_answer(message: types.Message, state: FSMContext, *args, **kwarg
                                                                                   message=message.caption)
     message.text = chat_gpt_prompt
 
-    logger.info(f"User '{tg_user.username}' sends a picture with size ({image.width}, {image.height})")
+    logger.info(f"User '{tg_user.username}' sends a picture with size ({photo.width}, {photo.height}),"
+                f" decoded at ({image.width}, {image.height})")
 
     await asyncio.get_event_loop().create_task(communication_answer(message, state=state, is_image=True))
 
@@ -404,32 +435,88 @@ async def document_answer(session: Session,
     caption = message.caption
     current_user_data = await state.get_data()
     current_documents = current_user_data.get('documents') or []
+    current_document_ids = current_user_data.get('document_ids') or []
 
     if not check_if_extension_supported(file_info.file_path):
         await message.reply(settings.messages.documents.not_supported[lc])
         return
 
-    await message.reply(settings.messages.documents.loading[lc])
-
-    async with TypingBlock(message.chat):
+    file_id = file_info.file_unique_id
+    registered_document = get_document(session, file_id)
 
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            result = await message.bot.download_file(file_path=file_info.file_path, destination_dir=tmp_dir)
-            result.close()
+    loading_message = await message.reply(settings.messages.documents.loading[lc])
+    progress_message = ProgressMessage(loading_message, settings.messages.documents.progress[lc])
 
-            vectorstore = current_user_data.get('vectorstore')
-            splits = load_single_document(file_path=result.name,
-                                          file_name=message.document.file_name,
-                                          file_id=file_info.file_unique_id)
-            add_documents(vectorstore, documents=splits)
+    async with TypingBlock(message.chat):
+        await vector_index_ready.wait()  # vectors of this run must not be removed by the startup cleanup
+
+        # Repeated or forwarded file: reuse the summary and already indexed vectors if they still exist
+        attached_chunks = 0
+        if registered_document is not None:
+            attached_chunks = await asyncio.get_event_loop().run_in_executor(thread_pool,
+                                                                             copy_document_vectors,
+                                                                             registered_document.last_user_id,
+                                                                             tg_user.id,
+                                                                             file_id)
+
+        summary_task = None
+
+        async def scheduled_summary(first_chunks):
+            cost = sum(chunk.metadata.get('tokens_count', 0) for chunk in first_chunks) \
+                   + long_context_model.max_gen_tokens
+            async with get_generation_scheduler().slot(tg_user.id, tokens_package_config.level, cost):
+                request = asyncio.get_event_loop().run_in_executor(thread_pool, make_summary, first_chunks, tg_user)
+                hold_generation_slot(request)
+                return await asyncio.shield(request)
+
+        def start_summary(first_chunks):
+            # Summary is generated in parallel with embedding of the rest of the document
+            nonlocal summary_task
+            summary_task = asyncio.ensure_future(scheduled_summary(first_chunks))
+
+        if attached_chunks == 0:
+            ingestion_params = dict(user_id=tg_user.id,
+                                    file_name=message.document.file_name,
+                                    file_id=file_id,
+                                    first_chunks_count=SUMMARY_DOCS if registered_document is None else 0,
+                                    on_first_chunks=start_summary if registered_document is None else None,
+                                    on_progress=progress_message.update)
+            try:
+                # Documents of unknown size are downloaded to disk
+                if message.document.file_size is not None \
+                        and message.document.file_size <= settings.config.documents.in_memory_max_size:
+                    buffer = await message.bot.download_file(file_path=file_info.file_path)
+                    report = await ingest_document(file_path=file_info.file_path, data=buffer.getvalue(),
+                                                   **ingestion_params)
+                else:
+                    with tempfile.TemporaryDirectory() as tmp_dir:
+                        result = await message.bot.download_file(file_path=file_info.file_path, destination_dir=tmp_dir)
+                        result.close()
+                        report = await ingest_document(file_path=result.name, **ingestion_params)
+            except BaseException:
+                # The summary of a failed document is not needed, its generation must not outlive the upload
+                if summary_task is not None and not summary_task.done():
+                    summary_task.cancel()
+                    await asyncio.gather(summary_task, return_exceptions=True)
+                raise
+
+        if registered_document is None:
+            summary = await summary_task if summary_task is not None else ""
+            register_document(session, file_id, message.document.file_name, summary, report.chunks_count, tg_user.id)
+        else:
+            summary = registered_document.summary
+            register_document_reuse(session, registered_document, tg_user.id)
 
-            summary = await asyncio.get_event_loop().run_in_executor(thread_pool, make_summary, splits, tg_user)
-            document_info = build_document_info(file_info.file_unique_id, message.document.file_name, summary)
+        document_info = build_document_info(file_id, message.document.file_name, summary)
+        if document_info not in current_documents:
             current_documents.append(document_info)
+        if file_id not in current_document_ids:
+            current_document_ids.append(file_id)
 
-            logger.info(f"File uploaded by '{tg_user.username}' | '{tg_user.id}' {document_info}")
+        logger.info(f"File uploaded by '{tg_user.username}' | '{tg_user.id}' {document_info},"
+                    f" reused: {registered_document is not None}, attached chunks: {attached_chunks}")
 
-        await state.update_data({'documents': current_documents})
+        await state.update_data({'documents': current_documents, 'document_ids': current_document_ids})
 
     if message.caption != '' and message.caption is not None:
         message.text = caption
@@ -6,7 +6,7 @@ from aiogram.types import ReplyKeyboardRemove
 from sqlalchemy.orm import Session
 
 from app import settings
-from app.database.chroma_db_service import create_vector_store
+from app.database.chroma_db_service import schedule_user_vectors_removal
 from app.database.sql_db_service import UserEntity
 from app.database.entity_services.messages_service import get_last_message
 from app.utils.tg_bot_utils import clean_last_message_markup, delete_settings_message
@@ -27,7 +27,7 @@ async def setup_data(user: UserEntity, state: FSMContext):
         'personality': None,
         'custom_prompt': None,
         'documents': [],
-        'vectorstore': create_vector_store(user.user_id),
+        'document_ids': [],  # documents the model is allowed to search in
         'messaging_lock': asyncio.Lock(),
         'instant_messages_buffer': None,
         'generation_task': None,
@@ -47,6 +47,8 @@ async def reset_user_state(session: Session, user: UserEntity, state: FSMContext
     current_data = await state.get_data()
     if current_data.get('generation_task'):
         current_data.get('generation_task').cancel()
+    if current_data.get('documents'):
+        schedule_user_vectors_removal(user.user_id)
 
     last_message = get_last_message(session, user)
     if last_message is not None:
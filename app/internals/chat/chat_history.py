@@ -1,7 +1,19 @@
 import enum
+import itertools
+import logging
+from collections import deque
 from copy import deepcopy
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import List, Callable, Optional, Tuple
+
+from app import settings
+
+logger = logging.getLogger(__name__)
+
+# Window that can reach the model, plus reserve for the background summary to fold messages before they are evicted
+HISTORY_CAPACITY = settings.config.last_messages_count + settings.config.history_reserve_messages
+
+SUMMARY_FORMAT = "Summary of the earlier part of the conversation:\n{summary}"
 
 
 class ChatRole(enum.Enum):
@@ -11,48 +23,141 @@ class ChatRole(enum.Enum):
     FUNCTION = 3
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ChatMessage:
+    """
+    Immutable message record without per-instance __dict__, roles are shared enum members.
+    Token count and API representation are computed once and cached in the record,
+    so deep copies of the history (FSM get_data) share messages instead of copying them.
+    """
     role: ChatRole = None
     text: str = None
+    _tokens: tuple = field(default=None, init=False, repr=False, compare=False)  # (encoding name, tokens count)
+    _wire: dict = field(default=None, init=False, repr=False, compare=False)  # formatted for the model API
+
+    def cached_tokens(self, encoding_name: str) -> Optional[int]:
+        return self._tokens[1] if self._tokens is not None and self._tokens[0] == encoding_name else None
+
+    def cache_tokens(self, encoding_name: str, tokens_count: int):
+        object.__setattr__(self, '_tokens', (encoding_name, tokens_count))
 
+    def cached_wire(self) -> Optional[dict]:
+        return self._wire
 
-@dataclass
+    def cache_wire(self, wire: dict):
+        object.__setattr__(self, '_wire', wire)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+@dataclass(frozen=True, slots=True)
 class FunctionResponseMessage(ChatMessage):
     tool_call_id: str = None
+    compacted: bool = False  # replaced with a stub after it became stale
 
 
-@dataclass
-class FunctionCallMessage(ChatMessage):
+@dataclass(frozen=True, slots=True)
+class ToolCall:
     tool_call_id: str = None
     name: str = None
     arguments: dict = None
 
 
+@dataclass(frozen=True, slots=True)
+class FunctionCallMessage(ChatMessage):
+    tool_calls: Tuple[ToolCall, ...] = ()  # the model may request several calls at once
+
+    @property
+    def names(self) -> str:
+        return ",".join(tool_call.name for tool_call in self.tool_calls)
+
+
+def is_user_turn(message: ChatMessage) -> bool:
+    """A user message starts a turn, tool calls and responses belong to the turn before them"""
+    return type(message) is ChatMessage and message.role == ChatRole.USER
+
+
 class ChatHistory:
+    """
+    Ring buffer of the last HISTORY_CAPACITY messages, so per-session memory is bounded.
+    Every message leaving the buffer goes through '_evict' and is passed to 'spill_hook' (if set)
+    with a flag telling whether it was folded into the summary.
+    """
 
-    def __init__(self, system_prompt: str = None):
-        self._chat_history: List[ChatMessage] = []
+    spill_hook: Optional[Callable[['ChatHistory', List[ChatMessage], bool], None]] = None
+
+    def __init__(self, system_prompt: str = None, capacity: int = HISTORY_CAPACITY):
+        self._chat_history: deque = deque(maxlen=capacity)
         self.system_message = ChatMessage(role=ChatRole.SYSTEM, text=system_prompt) if system_prompt else None
+        self.summary: str = None  # rolling summary of messages folded out of the history
+        # Volatile context (e.g. current time), sent after the messages to keep the prompt prefix cacheable
+        self.suffix_message: ChatMessage = None
+        # Messages evicted before they were summarized, kept by the summarizer's hook for the next summary
+        self.spilled_messages: deque = deque(maxlen=settings.config.history_reserve_messages)
+
+    @property
+    def summary_message(self) -> ChatMessage:
+        return ChatMessage(role=ChatRole.SYSTEM, text=SUMMARY_FORMAT.format(summary=self.summary)) \
+            if self.summary else None
+
+    def fold_into_summary(self, folded_messages: List[ChatMessage], summary: str) -> bool:
+        """Replaces the head of history with the summary, if the head wasn't changed while it was summarized"""
+        if list(itertools.islice(self._chat_history, len(folded_messages))) != folded_messages:
+            return False
+        for _ in folded_messages:
+            self._chat_history.popleft()
+        self.summary = summary
+        self._evict(folded_messages, summarized=True)
+        return True
+
+    def _evict(self, evicted_messages: List[ChatMessage], summarized: bool = False):
+        if not evicted_messages:
+            return
+        if ChatHistory.spill_hook is not None:
+            ChatHistory.spill_hook(self, evicted_messages, summarized)
+        elif not summarized:
+            logger.debug(f"{len(evicted_messages)} messages evicted from chat history")
 
     def add_message(self, chat_message: ChatMessage):
+        if len(self._chat_history) == self._chat_history.maxlen:
+            self._evict([self._chat_history.popleft()])
         self._chat_history.append(chat_message)
 
+    def replace_message(self, index: int, chat_message: ChatMessage):
+        self._chat_history[index] = chat_message
+
     def drop_last_arc(self):
         last_message = self._chat_history.pop()
         while type(last_message) != ChatMessage or last_message.role != ChatRole.USER:
             last_message = self._chat_history.pop()
 
     def remove_function_responses(self):
-        self._chat_history = list(filter(lambda x: not isinstance(x, FunctionResponseMessage) and not isinstance(x, FunctionCallMessage), self._chat_history))
+        self.chat_history = list(filter(lambda x: not isinstance(x, FunctionResponseMessage) and not isinstance(x, FunctionCallMessage), self._chat_history))
 
     @property
-    def chat_history(self):
-        return deepcopy(self._chat_history)
+    def chat_history(self) -> List[ChatMessage]:
+        return deepcopy(list(self._chat_history))
 
     @chat_history.setter
     def chat_history(self, new_history: List[ChatMessage]):
-        self._chat_history = new_history
+        """Messages are matched by identity, so kept ones should come from 'messages', not deep copies"""
+        maxlen = self._chat_history.maxlen
+        kept_ids = {id(message) for message in new_history[-maxlen:]}
+        known_ids = kept_ids | {id(message) for message in self._chat_history}
+        # Old messages missing in the new history, then new ones that don't fit the buffer
+        dropped = [message for message in self._chat_history if id(message) not in kept_ids]
+        dropped += [message for message in new_history if id(message) not in known_ids]
+        self._chat_history = deque(new_history, maxlen=maxlen)
+        self._evict(dropped)
+
+    @property
+    def messages(self) -> List[ChatMessage]:
+        """Shallow copy for read-only access, messages must be replaced, not modified"""
+        return list(self._chat_history)
 
     def __len__(self):
         return len(self._chat_history)
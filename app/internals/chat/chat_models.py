@@ -1,3 +1,5 @@
+import asyncio
+import dataclasses
 import json
 import logging
 import time
@@ -11,7 +13,10 @@ from openai.openai_object import OpenAIObject
 
 from app import settings
 from app.internals.chat.chat_history import ChatHistory, ChatMessage, ChatRole, FunctionCallMessage, \
-    FunctionResponseMessage
+    FunctionResponseMessage, ToolCall
+from app.internals.chat.circuit_breaker import CircuitBreaker
+from app.internals.chat.generation_scheduler import hold_generation_slot
+from app.internals.chat.rate_limiter import RateLimiter
 from app.settings import ModelConfig
 from app.utils.misc import percent_trim_list
 
@@ -20,6 +25,13 @@ logger = logging.getLogger(__name__)
 MAX_HIST_LEN = settings.config.last_messages_count
 openai.api_key = settings.config.OPENAI_KEY
 
+RETRIABLE_ERRORS = (openai.error.APIError, openai.error.Timeout, openai.error.APIConnectionError,
+                    openai.error.ServiceUnavailableError, openai.error.TryAgain)
+
+
+class ModelUnavailableError(Exception):
+    pass
+
 
 @dataclass
 class TextGenerationResult:
@@ -27,6 +39,7 @@ class TextGenerationResult:
     is_function_call: bool
     time_taken: int  # in ms
     prompt_tokens_usage: int
+    cached_tokens_usage: int  # prompt tokens served from the provider's prompt cache
     completion_tokens_usage: int
     total_tokens_usage: int
     retires_count: int
@@ -40,6 +53,14 @@ class BaseChatModel(ABC):
         tokens_field = 'max_tokens' if 'max_tokens' in self.config.generation_params.keys() else 'max_new_tokens'
         tokens_field = 'max_completion_tokens' if 'max_completion_tokens' in self.config.generation_params.keys() else tokens_field
         self.max_gen_tokens = self.config.generation_params.get(tokens_field, 856)
+        self.rate_limiter = RateLimiter(config.requests_per_minute, config.tokens_per_minute)
+        self.circuit_breaker = CircuitBreaker(config.model_name, settings.config.model_router)
+
+    @property
+    @abstractmethod
+    def encoding_name(self) -> str:
+        """Models with the same encoding share cached tokens counts"""
+        pass
 
     @abstractmethod
     def tokenize_sentence(self, message: str) -> list:
@@ -61,42 +82,104 @@ class BaseChatModel(ABC):
         pass
 
     @abstractmethod
-    def count_tokens_overflow(self, history: ChatHistory, functions: list) -> typing.Tuple[int, list]:
+    def count_prompt_tokens(self, history: ChatHistory, functions: list) -> typing.Tuple[int, list]:
+        """Returns prompt tokens count and the part of chat history that can be sent"""
         pass
 
-    def _truncate_history(self, history: ChatHistory, functions: list):
+    def count_tokens_overflow(self, history: ChatHistory, functions: list) -> typing.Tuple[int, list]:
+        prompt_tokens, chat_history = self.count_prompt_tokens(history, functions)
+        tokens_to_remove = max(prompt_tokens + self.max_gen_tokens - self.config.max_context_size, 0)
+        return tokens_to_remove, chat_history
+
+    def _truncate_history(self, history: ChatHistory, functions: list) -> typing.Tuple[list, int]:
         """
-        Truncates chat history in three ways:
+        Truncates a copy of chat history for the request, the session history is not changed, in three ways:
         1) Removes messages from the beginning those go beyond the allowed history length
         2) If history has many message: Drops messages from the beginning of the history until needed amount of free tokens reached
         3) If history has only one message - iteratively trim that message from the end by 10% of its length
+        Returns the truncated messages and estimated prompt tokens count after truncation.
         """
-        tokens_to_remove, chat_history = self.count_tokens_overflow(history, functions)
+        prompt_tokens, chat_history = self.count_prompt_tokens(history, functions)
+        tokens_to_remove = max(prompt_tokens + self.max_gen_tokens - self.config.max_context_size, 0)
 
         while tokens_to_remove > 0:
             if len(chat_history) > 1 and type(chat_history[-1]) is not FunctionResponseMessage:
                 dropped_message = chat_history.pop(0)
                 tokens_to_remove -= self.count_tokens(dropped_message)
-                if type(dropped_message) is FunctionCallMessage and len(chat_history) > 0:
-                    dropped_message = chat_history.pop(0)  # remove following FunctionResponseMessage
-                    tokens_to_remove -= self.count_tokens(dropped_message)
+                if type(dropped_message) is FunctionCallMessage:
+                    # remove all following FunctionResponseMessages, one per tool call
+                    while len(chat_history) > 0 and type(chat_history[0]) is FunctionResponseMessage:
+                        tokens_to_remove -= self.count_tokens(chat_history.pop(0))
             else:
                 tokens = self.tokenize_sentence(chat_history[-1].text)
                 new_tokens = percent_trim_list(tokens, percent=min(tokens_to_remove / len(tokens), 0.05))
                 tokens_to_remove -= len(tokens) - len(new_tokens)
                 # tokens_to_remove -= (len(tokens) - len(new_tokens))
-                chat_history[-1].text = self.detokenize_sentence(new_tokens)
-
-        history.chat_history = chat_history
-
-    def generate_answer(self, history: ChatHistory, functions=None, function_call=None) -> TextGenerationResult:
-        self._truncate_history(history, functions)
-
-        formatted_history = self._format_history(history)
-        return self._generate_answer(formatted_history, functions, function_call)
+                # messages are immutable, trimmed copy has no cached tokens count
+                chat_history[-1] = dataclasses.replace(chat_history[-1], text=self.detokenize_sentence(new_tokens))
+
+        return chat_history, min(prompt_tokens, self.config.max_context_size - self.max_gen_tokens)
+
+    def _prepare_request(self, history: ChatHistory, functions: list) -> typing.Tuple[object, int]:
+        chat_history, prompt_tokens = self._truncate_history(history, functions)
+        return self._format_history(history, chat_history), prompt_tokens + self.max_gen_tokens
+
+    def _generate_reserved(self, formatted_history, functions, function_call,
+                           reserved_tokens: int, probe_id: int = None) -> TextGenerationResult:
+        result = None
+        is_ok = None  # errors of the request itself (e.g. invalid request) say nothing about the model's health
+        start_time = time.monotonic()
+        try:
+            result = self._generate_answer(formatted_history, functions, function_call)
+            is_ok = True
+            return result
+        except (ModelUnavailableError, *RETRIABLE_ERRORS):
+            is_ok = False
+            raise
+        finally:
+            if is_ok is not None:
+                self.circuit_breaker.record(is_ok, time.monotonic() - start_time, probe_id)
+            elif probe_id is not None:
+                self.circuit_breaker.release_probe(probe_id)
+            self.rate_limiter.reconcile(reserved_tokens, result.total_tokens_usage if result is not None else 0)
+
+    def generate_answer(self, history: ChatHistory, functions=None, function_call=None,
+                        probe_id: int = None) -> TextGenerationResult:
+        """Blocking generation for pool threads, waits for the rate limit in the thread"""
+        try:
+            formatted_history, reserved_tokens = self._prepare_request(history, functions)
+            self.rate_limiter.acquire_sync(reserved_tokens)
+        except BaseException:
+            if probe_id is not None:
+                self.circuit_breaker.release_probe(probe_id)
+            raise
+        return self._generate_reserved(formatted_history, functions, function_call, reserved_tokens, probe_id)
+
+    async def agenerate_answer(self, history: ChatHistory, functions=None, function_call=None,
+                               probe_id: int = None) -> TextGenerationResult:
+        """
+        Waits for the rate limit on the event loop, so pool threads are busy only with requests being sent.
+        'probe_id' is given by the circuit breaker if the request is its half-open probe.
+        """
+        from app.bot import thread_pool
+
+        loop = asyncio.get_event_loop()
+        try:
+            formatted_history, reserved_tokens = await loop.run_in_executor(thread_pool, self._prepare_request,
+                                                                            history, functions)
+            await self.rate_limiter.acquire(reserved_tokens)
+        except BaseException:
+            if probe_id is not None:
+                self.circuit_breaker.release_probe(probe_id)
+            raise
+        request = loop.run_in_executor(thread_pool, self._generate_reserved, formatted_history,
+                                       functions, function_call, reserved_tokens, probe_id)
+        hold_generation_slot(request)
+        return await asyncio.shield(request)  # if cancelled, the request is still tracked until the thread ends
 
     @abstractmethod
     def _generate_answer(self, formatted_history, functions, function_call) -> TextGenerationResult:
+        """Raises ModelUnavailableError if the model didn't answer"""
         pass
 
     @abstractmethod
@@ -108,7 +191,7 @@ class BaseChatModel(ABC):
         pass
 
     @abstractmethod
-    def _format_history(self, history: ChatHistory) -> object:
+    def _format_history(self, history: ChatHistory, chat_history: list) -> object:
         pass
 
     @abstractmethod
@@ -127,7 +210,19 @@ class OpenAIChatModel(BaseChatModel):
 
     def __init__(self, config: ModelConfig):
         super().__init__(config)
-        self.tokenizer = tiktoken.encoding_for_model(self.config.model_name)
+        self._tokenizer = None
+        self._functions_tokens = {}  # functions names -> tokens count, definitions are static
+
+    @property
+    def tokenizer(self) -> tiktoken.Encoding:
+        # Encoding is loaded on first use (or during warm-up), loading takes a while
+        if self._tokenizer is None:
+            self._tokenizer = tiktoken.encoding_for_model(self.config.model_name)
+        return self._tokenizer
+
+    @property
+    def encoding_name(self) -> str:
+        return self.tokenizer.name
 
     def tokenize_sentence(self, message: str) -> list:
         return self.tokenizer.encode(message)
@@ -136,18 +231,34 @@ class OpenAIChatModel(BaseChatModel):
         return self.tokenizer.decode(tokens)
 
     def count_tokens(self, message: ChatMessage) -> int:
+        tokens_count = message.cached_tokens(self.encoding_name)
+        if tokens_count is None:
+            tokens_count = self._count_message_tokens(message)
+            message.cache_tokens(self.encoding_name, tokens_count)
+        return tokens_count
+
+    def _count_message_tokens(self, message: ChatMessage) -> int:
         if type(message) == ChatMessage:
             return self._count_str_tokens(message.text)
         elif type(message) == FunctionCallMessage:
-            arguments_tokens = 0
-            for k, v in message.arguments.items():
-                arguments_tokens += self._count_str_tokens(k)
-                arguments_tokens += self._count_str_tokens(v)
-            return self._count_str_tokens(message.name) + arguments_tokens
+            calls_tokens = 0
+            for tool_call in message.tool_calls:
+                calls_tokens += self._count_str_tokens(tool_call.name)
+                for k, v in tool_call.arguments.items():
+                    calls_tokens += self._count_str_tokens(k)
+                    v = v if isinstance(v, str) else json.dumps(v, ensure_ascii=False)  # array arguments
+                    calls_tokens += self._count_str_tokens(v)
+            return calls_tokens
         elif type(message) == FunctionResponseMessage:
             return self._count_str_tokens(message.text)
 
     def count_functions_prompt_tokens(self, functions: list) -> int:
+        functions_set = tuple(function['function']['name'] for function in functions)
+        if functions_set not in self._functions_tokens:
+            self._functions_tokens[functions_set] = self._count_functions_tokens(functions)
+        return self._functions_tokens[functions_set]
+
+    def _count_functions_tokens(self, functions: list) -> int:
         functions_tokens = 0
         for function in functions:
             functions_tokens += self._count_str_tokens(function['function']['name'])
@@ -157,20 +268,33 @@ class OpenAIChatModel(BaseChatModel):
                 functions_tokens += self._count_str_tokens(v['description'])
         return functions_tokens
 
-    def count_tokens_overflow(self, history: ChatHistory, functions: list) -> typing.Tuple[int, list]:
-        chat_history = history.chat_history[-MAX_HIST_LEN:]
+    def count_prompt_tokens(self, history: ChatHistory, functions: list) -> typing.Tuple[int, list]:
+        chat_history = history.messages[-MAX_HIST_LEN:]
+        # Responses can't be sent without their tool calls message
+        while len(chat_history) > 0 and type(chat_history[0]) is FunctionResponseMessage:
+            chat_history.pop(0)
 
         total_tokens = sum([self.count_tokens(message) for message in chat_history])
         total_tokens += 4 * len(chat_history)
         if history.system_message:
             total_tokens += self.count_tokens(history.system_message) + 11
+        if history.summary_message:
+            total_tokens += self.count_tokens(history.summary_message) + 4
+        if history.suffix_message:
+            total_tokens += self.count_tokens(history.suffix_message) + 4
         if functions:
             total_tokens += self.count_functions_prompt_tokens(functions) + 50
-
-        tokens_to_remove = max(total_tokens + self.max_gen_tokens - self.config.max_context_size, 0)
-        return tokens_to_remove, chat_history
+        return total_tokens, chat_history
 
     def _format_message(self, message: ChatMessage) -> object:
+        # Wire format is the same for all OpenAI models, it is built once per message
+        wire = message.cached_wire()
+        if wire is None:
+            wire = self._build_wire_message(message)
+            message.cache_wire(wire)
+        return wire
+
+    def _build_wire_message(self, message: ChatMessage) -> dict:
         if isinstance(message, FunctionResponseMessage):
             return {"role": self.ROLES_TEXT_MAPPING[ChatRole.FUNCTION],
                     "content": message.text,
@@ -178,59 +302,89 @@ class OpenAIChatModel(BaseChatModel):
         elif isinstance(message, FunctionCallMessage):
             return {"role": self.ROLES_TEXT_MAPPING[ChatRole.ASSISTANT],
                     "content": None,
-                    "tool_calls": [{"id": message.tool_call_id, "type": "function", "function": {"name": message.name, "arguments": json.dumps(message.arguments, ensure_ascii=False)}}]}
+                    "tool_calls": [{"id": tool_call.tool_call_id, "type": "function", "function": {"name": tool_call.name, "arguments": json.dumps(tool_call.arguments, ensure_ascii=False)}}
+                                   for tool_call in message.tool_calls]}
         else:
             return {"role": self.ROLES_TEXT_MAPPING[message.role],
                     "content": message.text}
 
-    def _format_history(self, history: ChatHistory):
+    def _format_history(self, history: ChatHistory, chat_history: list):
+        # Stable parts go first, so that the provider's prompt cache matches the longest prefix
         if history.system_message is not None:
             openai_hist = [self._format_message(history.system_message)]
         else:
             openai_hist = []
-        return openai_hist + [
+        if history.summary_message is not None:
+            openai_hist.append(self._format_message(history.summary_message))
+        openai_hist += [
             self._format_message(message)
-            for message in history.chat_history
+            for message in chat_history
         ]
+        if history.suffix_message is not None:
+            openai_hist.append(self._format_message(history.suffix_message))
+        return openai_hist
 
     def _is_function_call(self, message_container) -> bool:
         return message_container.get("tool_calls") is not None
 
     def _parse_output(self, message_container, is_function_call: bool) -> ChatMessage:
         if is_function_call:
-            return FunctionCallMessage(tool_call_id=message_container['tool_calls'][0]['id'],
-                                       name=message_container['tool_calls'][0]['function']['name'],
-                                       arguments=json.loads(message_container['tool_calls'][0]['function']['arguments']))
+            return FunctionCallMessage(role=ChatRole.ASSISTANT,
+                                       tool_calls=tuple(ToolCall(tool_call_id=tool_call['id'],
+                                                                 name=tool_call['function']['name'],
+                                                                 arguments=json.loads(tool_call['function']['arguments']))
+                                                        for tool_call in message_container['tool_calls']))
         return ChatMessage(role=self.TEXT_ROLES_MAPPING[message_container['role']], text=message_container['content'])
 
     def _generate_answer(self, formatted_history, functions, function_call) -> TextGenerationResult:
         start_time = int(time.time() * 1000)
-        for i in range(settings.config.openai_api_retries):
+        request_timeout = settings.config.model_router.request_timeout
+        retries = settings.config.openai_api_retries
+        last_error = None
+        for i in range(retries):
+            if i > 0 and self.circuit_breaker.is_open:
+                break  # other models will answer faster than retries
             try:
                 if functions is not None and len(functions) > 0:  # openai.error.InvalidRequestError fix
                     response: OpenAIObject = openai.ChatCompletion.create(messages=formatted_history,
                                                                           model=self.config.model_name,
                                                                           tools=functions,
                                                                           tool_choice=function_call,
+                                                                          request_timeout=request_timeout,
                                                                           **self.config.generation_params)
                 else:
                     response: OpenAIObject = openai.ChatCompletion.create(messages=formatted_history,
                                                                           model=self.config.model_name,
+                                                                          request_timeout=request_timeout,
                                                                           **self.config.generation_params)
                 time_taken = int(time.time() * 1000) - start_time
                 is_function_call = self._is_function_call(response['choices'][0]['message'])
                 chat_message = self._parse_output(response['choices'][0]['message'], is_function_call)
+                prompt_tokens_details = response['usage'].get('prompt_tokens_details') or {}
                 return TextGenerationResult(message=chat_message,
                                             time_taken=time_taken,
                                             is_function_call=is_function_call,
                                             prompt_tokens_usage=response['usage']['prompt_tokens'],
+                                            cached_tokens_usage=prompt_tokens_details.get('cached_tokens') or 0,
                                             completion_tokens_usage=response['usage']['completion_tokens'],
                                             total_tokens_usage=response['usage']['total_tokens'],
                                             model_config=self.config,
                                             retires_count=i)
-            except (openai.error.APIError, openai.error.RateLimitError) as e:
+            except openai.error.RateLimitError as e:
+                logger.warning(f"Got exception from OpenAI: {e}")
+                last_error = e
+                # All requests to the model wait for the reset, the retry is queued for a request slot
+                pause = self.rate_limiter.update_from_headers(e.headers, rate_limited=True)
+                if i + 1 < retries:
+                    if pause is None:
+                        time.sleep(2 ** i)  # no reset duration in the answer, wait longer
+                    self.rate_limiter.acquire_sync(0)
+            except RETRIABLE_ERRORS as e:
                 logger.warning(f"Got exception from OpenAI: {e}")
-                time.sleep(2 ** i)  # wait longer
+                last_error = e
+                if i + 1 < retries:
+                    time.sleep(2 ** i)  # wait longer
+        raise ModelUnavailableError(f"Model '{self.config.model_name}' didn't answer: {last_error}") from last_error
 
 
 def load_chat_model(model_config: ModelConfig) -> BaseChatModel:
@@ -0,0 +1,94 @@
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Optional, Tuple
+
+from app.settings import ModelRouterConfig
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Tracks outcomes of requests to one model over a time window.
+    The circuit is opened when the error rate or the 90th percentile of latency is too high,
+    then requests go to other models. After 'open_duration' one probe request is let through (half-open),
+    its success closes the circuit and its failure opens it again.
+    Only the outcome of the probe (identified by the id from 'allow_request') decides the half-open state,
+    outcomes of requests sent before the circuit was opened are ignored.
+    """
+
+    def __init__(self, name: str, config: ModelRouterConfig):
+        self.name = name
+        self.config = config
+        self._outcomes = deque()  # (finished at, is ok, latency in seconds)
+        self._opened_at = None
+        self._probe_started_at = None
+        self._probe_id = None
+        self._probe_ids = itertools.count(1)
+        self._lock = threading.Lock()  # outcomes are recorded from pool threads
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            return 'open' if time.monotonic() - self._opened_at < self.config.open_duration else 'half-open'
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == 'open'
+
+    def allow_request(self) -> Tuple[bool, Optional[int]]:
+        """Returns whether the request can be sent and the probe id, if the request is the half-open probe"""
+        with self._lock:
+            if self._opened_at is None:
+                return True, None
+            now = time.monotonic()
+            if now - self._opened_at < self.config.open_duration:
+                return False, None
+            # Half-open, one probe at a time (a probe that never finished expires)
+            if self._probe_started_at is not None and now - self._probe_started_at < self.config.open_duration:
+                return False, None
+            self._probe_started_at = now
+            self._probe_id = next(self._probe_ids)
+            return True, self._probe_id
+
+    def release_probe(self, probe_id: int):
+        """The probe ended without an outcome of the model's health, another probe can be sent"""
+        with self._lock:
+            if probe_id == self._probe_id:
+                self._probe_started_at = None
+                self._probe_id = None
+
+    def record(self, is_ok: bool, latency: float, probe_id: Optional[int] = None):
+        with self._lock:
+            now = time.monotonic()
+            if self._opened_at is not None:
+                if probe_id is None or probe_id != self._probe_id:
+                    return  # late outcome of a request sent before the circuit was opened, or of an expired probe
+                self._probe_started_at = None
+                self._probe_id = None
+                if is_ok:
+                    self._opened_at = None
+                    self._outcomes.clear()
+                    logger.info(f"Circuit of model '{self.name}' is closed")
+                else:
+                    self._opened_at = now
+                return
+
+            self._outcomes.append((now, is_ok, latency))
+            while self._outcomes and now - self._outcomes[0][0] > self.config.window:
+                self._outcomes.popleft()
+            if len(self._outcomes) < self.config.min_requests:
+                return
+
+            error_rate = sum(1 for _, ok, _ in self._outcomes if not ok) / len(self._outcomes)
+            latencies = sorted(latency for _, ok, latency in self._outcomes if ok)
+            p90_latency = latencies[int(len(latencies) * 0.9)] if latencies else 0.0
+            if error_rate >= self.config.error_rate_threshold or p90_latency >= self.config.slow_p90:
+                self._opened_at = now
+                logger.warning(f"Circuit of model '{self.name}' is opened, error rate: {error_rate:.2f}, "
+                               f"p90 latency: {p90_latency:.2f}s")
@@ -0,0 +1,50 @@
+import json
+import logging
+
+from app import settings
+from app.internals.chat.chat_history import ChatHistory, FunctionCallMessage, FunctionResponseMessage, \
+    is_user_turn
+from app.internals.chat.chat_models import BaseChatModel
+
+logger = logging.getLogger(__name__)
+
+TRUNCATED_MARK = "... [truncated to {max_tokens} tokens]"
+STALE_STUB = {"removed": "The result of '{name}' was removed from the history to save tokens. "
+                         "Call the function again if this information is needed."}
+
+
+def cap_function_response(model: BaseChatModel, response: FunctionResponseMessage,
+                          max_tokens: int = None) -> FunctionResponseMessage:
+    """Caps tool result at a tokens budget when it is created, the result stays in history for later turns"""
+    max_tokens = max_tokens or settings.config.function_responses.max_tokens
+    tokens = model.tokenize_sentence(response.text)
+    if len(tokens) <= max_tokens:
+        return response
+    logger.info(f"Function response '{response.tool_call_id}' capped from {len(tokens)} to {max_tokens} tokens")
+    text = model.detokenize_sentence(tokens[:max_tokens]) + TRUNCATED_MARK.format(max_tokens=max_tokens)
+    return FunctionResponseMessage(role=response.role, tool_call_id=response.tool_call_id, text=text)
+
+
+def compact_stale_function_responses(history: ChatHistory, stale_after_turns: int = None) -> int:
+    """
+    Replaces responses of tool calls made more than 'stale_after_turns' user turns ago with compact stubs.
+    Returns count of compacted responses.
+    """
+    stale_after_turns = stale_after_turns if stale_after_turns is not None \
+        else settings.config.function_responses.stale_after_turns
+    messages = history.messages
+    names = {}  # tool_call_id -> function name
+    turns_after = sum(1 for message in messages if is_user_turn(message))
+    compacted = 0
+    for i, message in enumerate(messages):
+        if is_user_turn(message):
+            turns_after -= 1
+        elif type(message) is FunctionCallMessage:
+            names.update({tool_call.tool_call_id: tool_call.name for tool_call in message.tool_calls})
+        elif type(message) is FunctionResponseMessage and turns_after >= stale_after_turns and not message.compacted:
+            stub = json.dumps({k: v.format(name=names.get(message.tool_call_id, 'function'))
+                               for k, v in STALE_STUB.items()}, ensure_ascii=False)
+            history.replace_message(i, FunctionResponseMessage(role=message.role, tool_call_id=message.tool_call_id,
+                                                               text=stub, compacted=True))
+            compacted += 1
+    return compacted
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import time
+from collections import deque, defaultdict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+
+from app import settings
+from app.settings import GenerationSchedulerConfig
+
+logger = logging.getLogger(__name__)
+
+WAITS_WINDOW = 1000  # last waits kept per tier for stats
+
+
+class _UserQueue:
+    __slots__ = ('level', 'requests', 'deficit', 'in_flight')
+
+    def __init__(self, level: int):
+        self.level = level
+        self.requests = deque()  # (cost, future)
+        self.deficit = 0
+        self.in_flight = 0
+
+
+class _SlotHold:
+    """
+    Keeps a slot until requests sent in it end. A cancelled generation can't stop the pool thread
+    that sends its request, so the slot is released only when the thread is done.
+    """
+    __slots__ = ('_release', '_pending', '_closed')
+
+    def __init__(self, release: Callable[[], None]):
+        self._release = release
+        self._pending = 0
+        self._closed = False
+
+    def hold(self, future: asyncio.Future):
+        self._pending += 1
+        future.add_done_callback(self._request_done)
+
+    def _request_done(self, future: asyncio.Future):
+        if not future.cancelled():
+            future.exception()  # retrieved, the awaiting task could be cancelled
+        self._pending -= 1
+        if self._closed and self._pending == 0:
+            self._release()
+
+    def close(self):
+        self._closed = True
+        if self._pending == 0:
+            self._release()
+
+
+_current_hold: ContextVar[Optional[_SlotHold]] = ContextVar('generation_slot_hold', default=None)
+
+
+def hold_generation_slot(future: asyncio.Future):
+    """
+    Called with the executor future of a request, the slot of the current generation (if any) waits for it.
+    The future should be awaited through asyncio.shield, so cancellation of the task doesn't finish it early.
+    """
+    hold = _current_hold.get()
+    if hold is not None:
+        hold.hold(future)
+
+
+class GenerationScheduler:
+    """
+    Deficit round robin of generations across users. Every turn a user gets a quantum of tokens
+    multiplied by the weight of the package level, and sends requests while their estimated costs fit.
+    So users with bursts or long documents prompts can't starve others, and paid tiers get bigger shares.
+    Total and per-user counts of requests in flight are capped, a slot is held until its requests really end.
+    """
+
+    def __init__(self, config: GenerationSchedulerConfig):
+        self.config = config
+        self._users: Dict[int, _UserQueue] = {}
+        self._active = deque()  # users with waiting requests, in round robin order
+        self._in_flight = 0
+        self._waits = defaultdict(lambda: deque(maxlen=WAITS_WINDOW))  # level -> waits in seconds
+
+    def _weight(self, level: int) -> int:
+        return level + 1  # default package has level 0
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, level: int, cost: int):
+        """Waits for a turn of the user, the generation is made inside the context"""
+        start_time = time.monotonic()
+        await self._acquire(user_id, level, max(cost, 1))
+        self._waits[level].append(time.monotonic() - start_time)
+        hold = _SlotHold(lambda: self._release(user_id))
+        token = _current_hold.set(hold)
+        try:
+            yield
+        finally:
+            _current_hold.reset(token)
+            hold.close()
+
+    async def _acquire(self, user_id: int, level: int, cost: int):
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = _UserQueue(level)
+        user.level = level  # package could be changed
+        future = asyncio.get_event_loop().create_future()
+        user.requests.append((cost, future))
+        if len(user.requests) == 1 and user_id not in self._active:
+            self._active.append(user_id)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():  # cancelled right after the turn was given
+                self._release(user_id)
+            else:
+                self._dispatch()  # cancelled request is dropped from the queue
+            raise
+
+    def _release(self, user_id: int):
+        user = self._users[user_id]
+        user.in_flight -= 1
+        self._in_flight -= 1
+        if user.in_flight == 0 and not user.requests and user_id not in self._active:
+            del self._users[user_id]
+        self._dispatch()
+
+    def _dispatch(self):
+        capped_users = 0  # the loop stops when all active users are at the in-flight cap
+        while self._active and self._in_flight < self.config.max_in_flight and capped_users < len(self._active):
+            user_id = self._active[0]
+            user = self._users[user_id]
+            while user.requests and user.requests[0][1].cancelled():
+                user.requests.popleft()
+            if not user.requests:
+                self._active.popleft()
+                user.deficit = 0
+                if user.in_flight == 0:
+                    del self._users[user_id]
+                continue
+            if user.in_flight >= self.config.per_user_in_flight:
+                self._active.rotate(-1)
+                capped_users += 1
+                continue
+            cost, future = user.requests[0]
+            if user.deficit < cost:
+                # Next turn, the user is served when accumulated quantum covers the request
+                user.deficit += self.config.quantum_tokens * self._weight(user.level)
+                self._active.rotate(-1)
+                capped_users = 0
+                continue
+            capped_users = 0
+            user.requests.popleft()
+            user.deficit -= cost
+            user.in_flight += 1
+            self._in_flight += 1
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        """Queue wait times in seconds per package level"""
+        tiers = {}
+        for level, waits in sorted(self._waits.items()):
+            sorted_waits = sorted(waits)
+            tiers[level] = {
+                'count': len(sorted_waits),
+                'avg_wait': round(sum(sorted_waits) / len(sorted_waits), 3),
+                'p95_wait': round(sorted_waits[int(len(sorted_waits) * 0.95)], 3)
+            }
+        return {
+            'in_flight': self._in_flight,
+            'waiting': sum(len(user.requests) for user in self._users.values()),
+            'tiers': tiers
+        }
+
+
+_generation_scheduler: Optional[GenerationScheduler] = None
+
+
+def get_generation_scheduler() -> GenerationScheduler:
+    global _generation_scheduler
+    if _generation_scheduler is None:
+        _generation_scheduler = GenerationScheduler(settings.config.generation_scheduler)
+    return _generation_scheduler
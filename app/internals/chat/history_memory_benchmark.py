@@ -0,0 +1,77 @@
+"""
+Memory and copy cost of resident chat histories: slotted immutable messages vs plain dataclasses.
+
+Usage: python -m app.internals.chat.history_memory_benchmark [--sessions 10000] [--messages 50]
+
+Texts are generated once and shared by both representations, so the difference is the records overhead.
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from copy import deepcopy
+from dataclasses import dataclass
+
+from app.internals.chat.chat_history import ChatHistory, ChatMessage, ChatRole
+
+COPIES = 200  # sessions deep copied to measure FSM get_data cost
+
+
+@dataclass
+class LegacyChatMessage:
+    role: ChatRole = None
+    text: str = None
+
+
+def _make_texts(messages_count: int):
+    return [f"Message number {i}, " + "some text of a usual length " * 8 for i in range(messages_count)]
+
+
+def _build_sessions(sessions_count: int, texts: list, legacy: bool) -> list:
+    sessions = []
+    for _ in range(sessions_count):
+        if legacy:
+            sessions.append([LegacyChatMessage(role=ChatRole.USER if i % 2 == 0 else ChatRole.ASSISTANT, text=text)
+                             for i, text in enumerate(texts)])
+        else:
+            history = ChatHistory(capacity=len(texts))
+            for i, text in enumerate(texts):
+                history.add_message(ChatMessage(role=ChatRole.USER if i % 2 == 0 else ChatRole.ASSISTANT, text=text))
+            sessions.append(history)
+    return sessions
+
+
+def _measure(sessions_count: int, texts: list, legacy: bool) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    sessions = _build_sessions(sessions_count, texts, legacy)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.time()
+    for session in sessions[:COPIES]:
+        deepcopy(session)
+    copy_time = (time.time() - start) * 1000 / COPIES
+    return {'memory_mb': memory / 1024 ** 2,
+            'bytes_per_message': memory / (sessions_count * len(texts)),
+            'copy_ms': copy_time}
+
+
+def run_benchmark(sessions_count: int, messages_count: int):
+    texts = _make_texts(messages_count)
+    results = {'dataclass': _measure(sessions_count, texts, legacy=True),
+               'slotted': _measure(sessions_count, texts, legacy=False)}
+
+    print(f"{sessions_count} sessions x {messages_count} messages (texts are shared and not counted)")
+    print(f"{'messages':<10} {'memory MB':>10} {'bytes/message':>14} {'deepcopy ms/session':>20}")
+    for name, result in results.items():
+        print(f"{name:<10} {result['memory_mb']:>10.1f} {result['bytes_per_message']:>14.1f} "
+              f"{result['copy_ms']:>20.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=10_000)
+    parser.add_argument('--messages', type=int, default=50)
+    args = parser.parse_args()
+    run_benchmark(args.sessions, args.messages)
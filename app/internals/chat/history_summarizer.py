@@ -0,0 +1,122 @@
+import asyncio
+import itertools
+import logging
+from typing import List
+
+from aiogram.dispatcher import FSMContext
+
+from app import settings
+from app.bot import small_context_model, thread_pool
+from app.internals.chat.chat_history import ChatHistory, ChatMessage, ChatRole, FunctionCallMessage, \
+    FunctionResponseMessage, is_user_turn
+from app.internals.chat.chat_models import BaseChatModel, MAX_HIST_LEN
+
+logger = logging.getLogger(__name__)
+
+SUMMARIZE_HISTORY_PROMPT = "You are given a summary of a conversation between a user and an AI-assistant and its continuation. Write an updated summary that keeps all facts, names, numbers, decisions, user preferences and open questions needed to continue the conversation. Write in the language of the conversation, be concise, answer with the summary only.\n\nPrevious summary:\n{summary}\n\nContinuation:\n{transcript}"
+
+TRANSCRIPT_ROLES = {ChatRole.USER: "User", ChatRole.ASSISTANT: "Assistant"}
+
+_summarizing_users = set()  # one background summary per user at a time
+
+
+def select_folded_messages(model: BaseChatModel, messages: List[ChatMessage],
+                           target_tokens: int, keep_last_messages: int) -> List[ChatMessage]:
+    """
+    Selects the head of history to fold into the summary, when history is over the tokens target or length limit.
+    The head is cut before a user message (tool calls stay with responses), so that the rest fits a half of the target.
+    """
+    tokens = [model.count_tokens(message) + 4 for message in messages]
+    remaining_tokens = sum(tokens)
+    if remaining_tokens <= target_tokens and len(messages) <= MAX_HIST_LEN:
+        return []
+
+    fold_count = 0
+    for i in range(1, len(messages) - keep_last_messages + 1):
+        remaining_tokens -= tokens[i - 1]
+        if not is_user_turn(messages[i]):
+            continue
+        fold_count = i
+        if remaining_tokens <= target_tokens // 2 and len(messages) - i <= MAX_HIST_LEN:
+            break
+    return messages[:fold_count]
+
+
+def _format_transcript(messages: List[ChatMessage]) -> str:
+    lines = []
+    for message in messages:
+        if type(message) is FunctionCallMessage:
+            lines.append(f"[Assistant used: {message.names}]")
+        elif type(message) is not FunctionResponseMessage:  # tool results are too long and mostly stale
+            lines.append(f"{TRANSCRIPT_ROLES.get(message.role, 'System')}: {message.text}")
+    return "\n\n".join(lines)
+
+
+def summarize_messages(model: BaseChatModel, previous_summary: str, messages: List[ChatMessage]) -> str:
+    prompt = SUMMARIZE_HISTORY_PROMPT.format(summary=previous_summary or "-",
+                                             transcript=_format_transcript(messages))
+    summary_hist = ChatHistory()  # No system prompt here
+    summary_hist.add_message(ChatMessage(role=ChatRole.USER, text=prompt))
+    result = model.generate_answer(summary_hist)
+    logger.info(f"History summary generated, folded messages: {len(messages)}, "
+                f"prompt tokens: {result.prompt_tokens_usage}, "
+                f"completion tokens: {result.completion_tokens_usage}, "
+                f"time taken: {result.time_taken}")
+    return result.message.text.strip()
+
+
+def _keep_spilled_messages(history: ChatHistory, evicted_messages: List[ChatMessage], summarized: bool):
+    """Spill hook of chat histories, messages evicted before they were summarized go to the next summary"""
+    if summarized or not settings.config.history_summary.enabled:
+        return
+    lost_count = max(len(history.spilled_messages) + len(evicted_messages) - history.spilled_messages.maxlen, 0)
+    if lost_count:
+        logger.info(f"{lost_count} messages evicted from chat history without summary")
+    history.spilled_messages.extend(evicted_messages)
+
+
+ChatHistory.spill_hook = _keep_spilled_messages
+
+
+def _pop_spilled_messages(history: ChatHistory, spilled_messages: List[ChatMessage]) -> bool:
+    if list(itertools.islice(history.spilled_messages, len(spilled_messages))) != spilled_messages:
+        return False
+    for _ in spilled_messages:
+        history.spilled_messages.popleft()
+    return True
+
+
+async def _fold_history(state: FSMContext, user_id: int, previous_summary: str, spilled_messages: List[ChatMessage],
+                        messages: List[ChatMessage], messages_lock: asyncio.Lock):
+    try:
+        loop = asyncio.get_event_loop()
+        config = settings.config.history_summary
+        # Tokens of long messages (e.g. function responses) are counted in the thread pool, not on the event loop
+        folded_messages = await loop.run_in_executor(thread_pool, select_folded_messages, small_context_model,
+                                                     messages, config.target_tokens, config.keep_last_messages)
+        if not folded_messages and not spilled_messages:
+            return
+        summary = await loop.run_in_executor(thread_pool, summarize_messages, small_context_model,
+                                             previous_summary, spilled_messages + folded_messages)
+        async with messages_lock:  # not in the middle of an answer generation
+            history: ChatHistory = (await state.get_data()).get('history')
+            # History could be reset or changed by regeneration while the summary was generated
+            if history is None or history.summary != previous_summary \
+                    or not _pop_spilled_messages(history, spilled_messages) \
+                    or not history.fold_into_summary(folded_messages, summary):
+                logger.info(f"History summary for user '{user_id}' discarded, history was changed")
+                return
+            await state.update_data({'history': history})
+    except Exception as e:
+        logger.warning(f"History summary for user '{user_id}' failed: {e}")
+    finally:
+        _summarizing_users.discard(user_id)
+
+
+def schedule_history_summary(state: FSMContext, user_id: int, history: ChatHistory, messages_lock: asyncio.Lock):
+    """Called after an answer is sent, the summary is generated in background by the small model"""
+    if not settings.config.history_summary.enabled or user_id in _summarizing_users:
+        return
+    _summarizing_users.add(user_id)
+    asyncio.create_task(_fold_history(state, user_id, history.summary, list(history.spilled_messages),
+                                      history.messages, messages_lock))
@@ -0,0 +1,48 @@
+import asyncio
+import logging
+from typing import List
+
+from app.internals.chat.chat_history import ChatHistory
+from app.internals.chat.chat_models import BaseChatModel, TextGenerationResult, ModelUnavailableError
+
+logger = logging.getLogger(__name__)
+
+
+def _fits_context(model: BaseChatModel, prompt_tokens: int) -> bool:
+    return prompt_tokens + model.max_gen_tokens <= model.config.max_context_size
+
+
+def route_models(history: ChatHistory, functions: list, models: List[BaseChatModel]) -> List[BaseChatModel]:
+    """Orders models to try: the preferred (first) one, then others that fit the prompt the preferred one would get"""
+    preferred_model = models[0]
+    prompt_tokens = min(preferred_model.count_prompt_tokens(history, functions)[0],
+                        preferred_model.config.max_context_size - preferred_model.max_gen_tokens)
+    return [preferred_model] + [model for model in models[1:] if _fits_context(model, prompt_tokens)]
+
+
+async def agenerate_with_failover(models: List[BaseChatModel], history: ChatHistory,
+                                  functions=None, function_call=None) -> TextGenerationResult:
+    """
+    Tries routed models in order, skipping models with open circuits, until one of them answers.
+    If all circuits are open, the preferred model is tried anyway. Raises the last error if no model answered.
+    """
+    from app.bot import thread_pool
+
+    routed_models = await asyncio.get_event_loop().run_in_executor(thread_pool, route_models,
+                                                                   history, functions, models)
+    last_error = None
+    for model in routed_models:
+        # Checked just before the request, a half-open circuit lets only the request it is checked for
+        is_allowed, probe_id = model.circuit_breaker.allow_request()
+        if not is_allowed:
+            continue
+        if last_error is not None:
+            logger.warning(f"Failing over to model '{model.config.model_name}': {last_error}")
+        try:
+            return await model.agenerate_answer(history, functions, function_call, probe_id)
+        except ModelUnavailableError as e:
+            last_error = e
+    if last_error is None:
+        logger.warning("Circuits of all models are open, trying the preferred one")
+        return await routed_models[0].agenerate_answer(history, functions, function_call)
+    raise last_error
@@ -0,0 +1,75 @@
+import logging
+from functools import lru_cache
+from string import Formatter
+from typing import Dict
+
+from app import settings
+from app.internals.chat.chat_history import ChatMessage, ChatRole
+from app.internals.chat.chat_models import BaseChatModel
+
+logger = logging.getLogger(__name__)
+
+DOCUMENTS_FIELD = "{documents_desc}"  # documents description is appended to every system prompt
+
+
+class PromptTemplate:
+    """
+    System prompt template parsed once. Its static text is tokenized once per encoding,
+    so a request tokenizes only the substituted values.
+    Tokens count of the whole prompt may differ from the exact one by a few tokens at the fields' borders.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        self._parts = [(literal, field_name) for literal, field_name, _, _ in Formatter().parse(template)]
+        self.fields = [field_name for _, field_name in self._parts if field_name]
+        self._static_tokens: Dict[str, int] = {}  # encoding name -> tokens count
+
+    def format(self, **values) -> str:
+        return "".join(literal + (str(values[field_name]) if field_name else "")
+                       for literal, field_name in self._parts)
+
+    def static_tokens(self, model: BaseChatModel) -> int:
+        if model.encoding_name not in self._static_tokens:
+            self._static_tokens[model.encoding_name] = len(model.tokenize_sentence(
+                "".join(literal for literal, _ in self._parts)))
+        return self._static_tokens[model.encoding_name]
+
+    def count_tokens(self, model: BaseChatModel, **values) -> int:
+        return self.static_tokens(model) + sum(len(model.tokenize_sentence(str(values[field_name])))
+                                               for field_name in self.fields if values[field_name])
+
+    def build_message(self, model: BaseChatModel, **values) -> ChatMessage:
+        """System message with the tokens count already cached for the model's encoding"""
+        message = ChatMessage(role=ChatRole.SYSTEM, text=self.format(**values))
+        message.cache_tokens(model.encoding_name, self.count_tokens(model, **values))
+        return message
+
+
+_personality_templates: Dict[str, PromptTemplate] = {}
+
+
+def load_personality_templates():
+    global _personality_templates
+    _personality_templates = {name: PromptTemplate(personality.context + DOCUMENTS_FIELD)
+                              for name, personality in settings.personalities.items()}
+    logger.info(f"Personality prompt templates parsed. Count: {len(_personality_templates)}")
+
+
+def get_personality_template(personality: str) -> PromptTemplate:
+    return _personality_templates[personality]
+
+
+@lru_cache(maxsize=1024)
+def get_custom_template(custom_prompt: str) -> PromptTemplate:
+    return PromptTemplate(custom_prompt + DOCUMENTS_FIELD)
+
+
+def warm_up_templates(*models: BaseChatModel):
+    for template in _personality_templates.values():
+        for model in models:
+            template.static_tokens(model)
+
+
+load_personality_templates()
+settings.add_reload_listener(load_personality_templates)
@@ -0,0 +1,142 @@
+import asyncio
+import itertools
+import logging
+import re
+import threading
+import time
+from collections import deque
+from typing import Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.05  # in seconds, for requests waiting behind the head of the queue
+LONG_WAIT = 1.0  # waits longer than this are logged
+
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Parses OpenAI reset durations like '20ms', '1s', '6m0s' into seconds"""
+    if not value:
+        return None
+    try:
+        return float(value)  # 'retry-after' is in seconds
+    except ValueError:
+        parts = DURATION_PART.findall(value)
+        return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts) if parts else None
+
+
+class RateLimiter:
+    """
+    Token buckets of requests and tokens per minute of one model, refilled continuously.
+    A request reserves its estimated tokens (prompt + max generation) before it is sent
+    and the reservation is reconciled with the real usage after the answer.
+    Requests are served in FIFO order, async callers wait on the event loop, pool threads sleep.
+    Buckets are corrected by the rate limit headers of OpenAI, if they report less than expected.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._queue = deque()  # tickets of waiting requests
+        self._tickets = itertools.count()
+        self._lock = threading.Lock()  # reconciled from pool threads
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+        self._updated_at = now
+
+    def _enqueue(self) -> int:
+        with self._lock:
+            ticket = next(self._tickets)
+            self._queue.append(ticket)
+            return ticket
+
+    def _dequeue(self, ticket: int):
+        with self._lock:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+
+    def _try_acquire(self, ticket: int, tokens: int) -> float:
+        """Takes a request and tokens if the ticket is the first in the queue, otherwise returns seconds to wait"""
+        with self._lock:
+            if self._queue[0] != ticket:
+                return POLL_INTERVAL
+            now = time.monotonic()
+            self._refill(now)
+            tokens = min(tokens, self.tokens_per_minute)  # too big requests wait for the full bucket
+            wait = max(self._paused_until - now,
+                       (1 - self._requests) * 60 / self.requests_per_minute,
+                       (tokens - self._tokens) * 60 / self.tokens_per_minute)
+            if wait > 0:
+                return max(wait, POLL_INTERVAL)
+            self._requests -= 1
+            self._tokens -= tokens
+            self._queue.popleft()
+            return 0.0
+
+    async def acquire(self, tokens: int) -> float:
+        """Waits on the event loop until the request can be sent, returns waited time"""
+        start_time = time.monotonic()
+        ticket = self._enqueue()
+        try:
+            while (wait := self._try_acquire(ticket, tokens)) > 0:
+                await asyncio.sleep(wait)
+        finally:
+            self._dequeue(ticket)  # cancelled while waiting
+        return self._waited(start_time, tokens)
+
+    def acquire_sync(self, tokens: int) -> float:
+        """Same as acquire for callers in pool threads"""
+        start_time = time.monotonic()
+        ticket = self._enqueue()
+        try:
+            while (wait := self._try_acquire(ticket, tokens)) > 0:
+                time.sleep(wait)
+        finally:
+            self._dequeue(ticket)
+        return self._waited(start_time, tokens)
+
+    def _waited(self, start_time: float, tokens: int) -> float:
+        waited = time.monotonic() - start_time
+        if waited > LONG_WAIT:
+            logger.info(f"Request of {tokens} tokens waited {waited:.2f}s for the rate limit")
+        return waited
+
+    def reconcile(self, reserved_tokens: int, used_tokens: int):
+        """Returns unused part of the reservation, or takes the excess if the estimate was too low"""
+        with self._lock:
+            self._tokens = min(self.tokens_per_minute, self._tokens + reserved_tokens - used_tokens)
+
+    def update_from_headers(self, headers: Optional[Mapping[str, str]], rate_limited: bool = False) -> Optional[float]:
+        """
+        Lowers buckets to the remaining limits reported by OpenAI, pauses all requests after 429.
+        Returns the pause in seconds, None if the headers don't tell when the limit is reset.
+        """
+        if not headers:
+            return None
+        remaining_requests = headers.get('x-ratelimit-remaining-requests')
+        remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if remaining_requests is not None:
+                self._requests = min(self._requests, float(remaining_requests))
+            if remaining_tokens is not None:
+                self._tokens = min(self._tokens, float(remaining_tokens))
+            if rate_limited:
+                pause = parse_reset_duration(headers.get('retry-after')) \
+                        or max(parse_reset_duration(headers.get('x-ratelimit-reset-requests')) or 0,
+                               parse_reset_duration(headers.get('x-ratelimit-reset-tokens')) or 0)
+                if pause:
+                    self._paused_until = max(self._paused_until, now + pause)
+                    logger.warning(f"Rate limited by OpenAI, requests are paused for {pause:.2f}s")
+                    return pause
+        return None
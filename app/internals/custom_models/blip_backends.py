@@ -0,0 +1,135 @@
+import logging
+import os
+import threading
+from typing import List
+
+import torch
+from transformers import AutoProcessor, BlipForConditionalGeneration
+
+from app.settings import BlipConfig
+
+logger = logging.getLogger(__name__)
+
+
+class BlipCaptioner:
+    """
+    Default BLIP captioner: fp32 weights wrapped in torch.compile.
+
+    Subclasses only change how the model is loaded, captioning logic is shared.
+    """
+
+    def __init__(self, config: BlipConfig):
+        self.config = config
+        self.device = config.device
+        self.model_name = "Salesforce/blip-image-captioning-large" if config.use_large \
+            else "Salesforce/blip-image-captioning-base"
+        self.processor = AutoProcessor.from_pretrained(self.model_name)
+        self.model = self._load_model()
+
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+    def _load_model(self):
+        model = BlipForConditionalGeneration.from_pretrained(self.model_name).to(self.device)
+        return torch.compile(model)
+
+    def _generation_params(self, fast: bool) -> dict:
+        if fast:  # greedy decoding, no beams
+            return dict(num_beams=1, do_sample=False, use_cache=True,
+                        repetition_penalty=5.0, min_length=10, max_new_tokens=40)
+        return dict(num_beams=self.config.num_beams, use_cache=True,
+                    repetition_penalty=5.0, min_length=15, max_new_tokens=100)
+
+    def caption(self, images, fast: bool = None) -> List[str]:
+        """Generates captions, switches to the fast tier automatically if too many requests are in flight"""
+        with self._in_flight_lock:
+            self._in_flight += 1
+            under_load = self._in_flight > self.config.fast_tier_load
+        try:
+            fast = under_load if fast is None else fast
+            inputs = self.processor(images=images, return_tensors="pt").to(self.device)
+            with torch.inference_mode():
+                generated_ids = self.model.generate(**inputs, **self._generation_params(fast))
+            return self.processor.batch_decode(generated_ids, skip_special_tokens=True)
+        finally:
+            with self._in_flight_lock:
+                self._in_flight -= 1
+
+
+class Int8BlipCaptioner(BlipCaptioner):
+    """PyTorch dynamic int8 quantization of all linear layers, CPU only"""
+
+    def _load_model(self):
+        assert self.device == 'cpu', "Dynamic int8 quantization is supported only on cpu"
+        model = BlipForConditionalGeneration.from_pretrained(self.model_name).eval()
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class OnnxVisionModel(torch.nn.Module):
+    """Drop-in replacement of BLIP vision model which runs the exported encoder in ONNX Runtime"""
+
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+
+    def forward(self, pixel_values, **kwargs):
+        image_embeds = self.session.run(['image_embeds'], {'pixel_values': pixel_values.cpu().numpy()})[0]
+        return (torch.from_numpy(image_embeds),)
+
+
+class _VisionEncoderExport(torch.nn.Module):
+
+    def __init__(self, vision_model):
+        super().__init__()
+        self.vision_model = vision_model
+
+    def forward(self, pixel_values):
+        return self.vision_model(pixel_values=pixel_values)[0]
+
+
+class OnnxBlipCaptioner(BlipCaptioner):
+    """
+    Vision encoder exported to ONNX and executed by ONNX Runtime,
+    text decoder stays in PyTorch (dynamic int8) and keeps its native KV cache.
+    """
+
+    def _export_vision_encoder(self, model, onnx_path: str):
+        os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+        image_size = model.config.vision_config.image_size
+        dummy_pixels = torch.randn(1, 3, image_size, image_size)
+        torch.onnx.export(_VisionEncoderExport(model.vision_model), (dummy_pixels,), onnx_path,
+                          input_names=['pixel_values'], output_names=['image_embeds'],
+                          dynamic_axes={'pixel_values': {0: 'batch'}, 'image_embeds': {0: 'batch'}},
+                          opset_version=14)
+        logger.info(f"BLIP vision encoder exported to ONNX: {onnx_path}")
+
+    def _load_model(self):
+        try:
+            import onnxruntime  # optional dependency, needed only for this backend
+        except ImportError as e:
+            raise ImportError("BLIP backend 'onnx' requires onnxruntime, install it with "
+                              "'pip install onnxruntime==1.16.3' or select 'torch' or 'int8' backend") from e
+
+        assert self.device == 'cpu', "ONNX backend is supported only on cpu"
+        model = BlipForConditionalGeneration.from_pretrained(self.model_name).eval()
+
+        onnx_path = os.path.join(self.config.onnx_dir, self.model_name.replace('/', '_') + '_vision.onnx')
+        if not os.path.exists(onnx_path):
+            self._export_vision_encoder(model, onnx_path)
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = onnxruntime.InferenceSession(onnx_path, sess_options=session_options,
+                                               providers=['CPUExecutionProvider'])
+
+        model.vision_model = OnnxVisionModel(session)
+        model.text_decoder = torch.quantization.quantize_dynamic(model.text_decoder, {torch.nn.Linear},
+                                                                 dtype=torch.qint8)
+        return model
+
+
+CAPTIONERS_MAPPING = {
+    'torch': BlipCaptioner,
+    'int8': Int8BlipCaptioner,
+    'onnx': OnnxBlipCaptioner
+}
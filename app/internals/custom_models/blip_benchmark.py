@@ -0,0 +1,91 @@
+"""
+Latency, memory and caption quality benchmark of BLIP backends.
+
+Usage: python -m app.internals.custom_models.blip_benchmark image_1.jpg image_2.jpg ...
+
+Every backend is measured in a separate process, so memory numbers do not interfere.
+Quality is a token-level F1 of captions against the reference 'torch' backend with beam search.
+"""
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from collections import Counter
+from statistics import mean, median
+
+REPEATS = 3
+
+
+def _rss_mb() -> float:
+    with open('/proc/self/statm') as file:
+        rss_pages = int(file.read().split()[1])
+    return rss_pages * resource.getpagesize() / 1024 ** 2
+
+
+def _tokens_f1(candidate: str, reference: str) -> float:
+    candidate_tokens, reference_tokens = candidate.lower().split(), reference.lower().split()
+    common = sum((Counter(candidate_tokens) & Counter(reference_tokens)).values())
+    if common == 0:
+        return 0.0
+    precision, recall = common / len(candidate_tokens), common / len(reference_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+
+def _run_backend(backend: str, image_paths: list, results_queue):
+    from PIL import Image
+
+    from app import settings
+    from app.internals.custom_models.blip_captions_model import load_blip_captioner
+
+    images = [Image.open(path).convert('RGB') for path in image_paths]
+
+    rss_before, load_start = _rss_mb(), time.time()
+    captioner = load_blip_captioner(settings.config.blip.copy(update={'backend': backend}))
+    load_time, model_rss = time.time() - load_start, _rss_mb() - rss_before
+
+    result = {'backend': backend, 'load_time': load_time, 'model_rss_mb': model_rss}
+    for tier, fast in [('beam', False), ('greedy', True)]:
+        captioner.caption(images[:1], fast=fast)  # warm up (compilation, allocations)
+        latencies, captions = [], []
+        for image in images:
+            for _ in range(REPEATS):
+                start = time.time()
+                caption = captioner.caption([image], fast=fast)[0]
+                latencies.append((time.time() - start) * 1000)
+            captions.append(caption)
+        result[tier] = {'median_ms': median(latencies), 'mean_ms': mean(latencies), 'captions': captions}
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results_queue.put(result)
+
+
+def run_benchmark(image_paths: list, backends: list):
+    context = multiprocessing.get_context('spawn')
+    results_queue = context.Queue()
+    results = {}
+    for backend in backends:
+        process = context.Process(target=_run_backend, args=(backend, image_paths, results_queue))
+        process.start()
+        results[backend] = results_queue.get()
+        process.join()
+
+    reference = results['torch']['beam']['captions'] if 'torch' in results else None
+    print(f"{'backend':<8} {'tier':<7} {'median ms':>10} {'mean ms':>10} {'model MB':>9} {'peak MB':>8} {'F1':>6}")
+    for backend, result in results.items():
+        for tier in ['beam', 'greedy']:
+            tier_result = result[tier]
+            f1 = mean(_tokens_f1(c, r) for c, r in zip(tier_result['captions'], reference)) if reference else float('nan')
+            print(f"{backend:<8} {tier:<7} {tier_result['median_ms']:>10.1f} {tier_result['mean_ms']:>10.1f} "
+                  f"{result['model_rss_mb']:>9.1f} {result['peak_rss_mb']:>8.1f} {f1:>6.3f}")
+    print()
+    for backend, result in results.items():
+        for tier in ['beam', 'greedy']:
+            for path, caption in zip(image_paths, result[tier]['captions']):
+                print(f"[{backend}/{tier}] {os.path.basename(path)}: {caption}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    run_benchmark(sys.argv[1:], ['torch', 'int8', 'onnx'])
@@ -1,32 +1,49 @@
 import logging
+import threading
+from typing import List
 
-import torch
-from transformers import AutoProcessor, BlipForConditionalGeneration
+from PIL import Image
 
-from app.bot import settings
+from app import settings
+from app.settings import BlipConfig
 
 logger = logging.getLogger(__name__)
 
-device = settings.config.blip.device
+BLIP_BACKENDS = ['torch', 'int8', 'onnx']
+BLIP_IMAGE_SIZE = 384  # input resolution of both base and large BLIP models
 
-blip_model_name = "Salesforce/blip-image-captioning-large" if settings.config.blip.use_large \
-    else "Salesforce/blip-image-captioning-base"
-blip_processor = AutoProcessor.from_pretrained(blip_model_name)
+_blip_captioner = None
+_blip_captioner_lock = threading.Lock()
 
-blip_model = BlipForConditionalGeneration.from_pretrained(blip_model_name).to(device)
-blip_model = torch.compile(blip_model)
 
-print(f'BLIP model loaded: {blip_model_name}, device: {device}')
+def load_blip_captioner(config: BlipConfig):
+    # torch and transformers are imported only here, they take seconds to import
+    from app.internals.custom_models.blip_backends import CAPTIONERS_MAPPING
 
+    assert config.backend in BLIP_BACKENDS, f"{config.backend} is not supported BLIP backend"
+    captioner = CAPTIONERS_MAPPING[config.backend](config)
+    logger.info(f'BLIP model loaded: {captioner.model_name}, backend: {config.backend}, device: {config.device}')
+    return captioner
 
-def get_images_captions(images):
-    inputs = blip_processor(images=images, return_tensors="pt").to(device)
 
-    with torch.inference_mode():
-        generated_ids = blip_model.generate(**inputs,
-                                            repetition_penalty=5.0,
-                                            num_beams=4, use_cache=True,
-                                            min_length=15, max_new_tokens=100)
+def get_blip_captioner():
+    """Loads the configured BLIP captioner on first use (or during warm-up)"""
+    global _blip_captioner
+    if _blip_captioner is None:
+        with _blip_captioner_lock:
+            if _blip_captioner is None:
+                _blip_captioner = load_blip_captioner(settings.config.blip)
+    return _blip_captioner
 
-    generated_texts = blip_processor.batch_decode(generated_ids, skip_special_tokens=True)
-    return generated_texts
+
+def decode_image(fp) -> Image.Image:
+    """Decodes image from a file object, JPEG is scaled by the decoder straight to the BLIP input resolution"""
+    image = Image.open(fp)
+    # Draft mode makes JPEG decoder skip DCT coefficients (1/2, 1/4, 1/8 scale) while keeping size >= requested,
+    # it is a no-op for other formats
+    image.draft('RGB', (BLIP_IMAGE_SIZE, BLIP_IMAGE_SIZE))
+    return image.convert('RGB')
+
+
+def get_images_captions(images, fast: bool = None) -> List[str]:
+    return get_blip_captioner().caption(images, fast=fast)
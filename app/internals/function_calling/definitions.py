@@ -1,5 +1,3 @@
-from copy import deepcopy
-
 from aiogram.dispatcher import FSMContext
 
 OPENAI_FUNCTIONS = [
@@ -7,20 +5,24 @@ OPENAI_FUNCTIONS = [
         "type": "function",
         "function": {
             "name": "search_in_document_query",
-            "description": "This function is designed to execute an information search in a specific document using a query string. Use this function if a user asks about information that may be contained in a document.",
+            "description": "This function is designed to execute an information search in documents using query strings. Use this function if a user asks about information that may be contained in documents. Every query is searched in every given document, so pass all needed queries and documents (e.g. to compare documents) in one call.",
             "parameters": {
                 "type": "object",
                 "properties": {
-                    "document_id": {
-                        "type": "string",
-                        "description": "ID of a relevant document",
+                    "document_ids": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "minItems": 1,
+                        "description": "IDs of relevant documents",
                     },
-                    "query": {
-                        "type": "string",
-                        "description": "Detailed search query based on user's request",
+                    "queries": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "minItems": 1,
+                        "description": "Detailed search queries based on user's request, one per each piece of needed information",
                     }
                 },
-                "required": ["document_id", "query"],
+                "required": ["document_ids", "queries"],
                 "additionalProperties": False
             },
             "strict": True
@@ -48,10 +50,12 @@ OPENAI_FUNCTIONS = [
 ]
 
 
+# Function sets are built once and shared by all requests, they must not be modified
+DOCUMENTS_FUNCTIONS = OPENAI_FUNCTIONS
+WEB_FUNCTIONS = OPENAI_FUNCTIONS[1:]
+
+
 async def build_openai_functions(state: FSMContext):
-    """Formats documents' descriptions from user vector db into OPENAI_FUNCTIONS"""
+    """Chooses the set of OPENAI_FUNCTIONS, documents search is available only if the user has documents"""
     current_data = await state.get_data()
-    personal_functions = deepcopy(OPENAI_FUNCTIONS)
-    if not current_data.get('documents'):
-        personal_functions.pop(0)
-    return personal_functions
+    return DOCUMENTS_FUNCTIONS if current_data.get('documents') else WEB_FUNCTIONS
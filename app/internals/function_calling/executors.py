@@ -1,34 +1,29 @@
+import asyncio
+import functools
+import itertools
 import json
 import logging
 from typing import List
 
-from langchain.vectorstores.chroma import Chroma
-
 from app import settings
+from app.bot import long_context_model, thread_pool
 from app.database.sql_db_service import UserEntity, TokensPackageEntity
-from app.internals.chat.chat_history import FunctionCallMessage, FunctionResponseMessage
-
-from langchain.document_loaders import AsyncHtmlLoader
-from langchain.document_transformers import Html2TextTransformer
-
-from app.utils.misc import clean_text
+from app.internals.chat.chat_history import ChatRole, FunctionCallMessage, FunctionResponseMessage, ToolCall
+from app.internals.chat.function_responses_policy import cap_function_response
+from app.internals.function_calling.hybrid_search import hybrid_search
+from app.internals.function_calling.web_fetcher import get_web_fetcher, PageTooLongError
 
 logger = logging.getLogger(__name__)
-html2text = Html2TextTransformer()
 
 
-def website_request(user: UserEntity, current_user_data: dict, url: str):
+async def website_request(user: UserEntity, current_user_data: dict, url: str):
     """Parses information from a website via a link 'url'"""
     try:
-        # vector_store: Chroma = current_user_data.get('vectorstore')
-        loader = AsyncHtmlLoader([url])
-        docs = loader.load()
-        docs = html2text.transform_documents(docs)
-        docs = [clean_text(doc.page_content) for doc in docs]
-        total_symbols = sum([len(doc) for doc in docs])
-        if total_symbols > 60_000:
-            return ("ERROR: The content of this website is too long for the assistant."
-                    " The assistant only works with short and medium-length pages (for example, news pages)")
+        docs = [await get_web_fetcher().fetch_text(url)]
+    except PageTooLongError as e:
+        logger.info(f"Website {url} is too long: {e} for user '{user.user_id}' | '{user.user_name}'")
+        return ("ERROR: The content of this website is too long for the assistant."
+                " The assistant only works with short and medium-length pages (for example, news pages)")
     except Exception as e:
         logger.info(f"Exception while getting html from {url}: {e} for user '{user.user_id}' | '{user.user_name}'")
         return ("ERROR: Most likely, the site is technically inaccessible to the assistant. "
@@ -36,16 +31,41 @@ def website_request(user: UserEntity, current_user_data: dict, url: str):
     return {"web_content": docs}
 
 
-def search_in_document_query(user: UserEntity, current_user_data: dict, document_id: str, query: str):
-    """Executes information search by 'query' in the document with id 'document_id'"""
-    vector_store: Chroma = current_user_data.get('vectorstore')
-    found_documents = vector_store.search(query,
-                                          search_type='similarity',
-                                          k=settings.config.documents.search_best_k,
-                                          filter={'file_id': document_id})
+async def search_in_document_query(user: UserEntity, current_user_data: dict, document_ids: List[str],
+                                   queries: List[str]):
+    """Executes information search by every query in every document, results are limited by a tokens budget"""
+    # Ids come from the model, only documents uploaded in the current session can be searched
+    allowed_ids = set(current_user_data.get('document_ids') or [])
+    unknown_ids = [document_id for document_id in document_ids if document_id not in allowed_ids]
+    if unknown_ids:
+        logger.warning(f"Unknown document ids {unknown_ids} requested by the model for user '{user.user_id}'")
+        return f"ERROR: Unknown document IDs: {', '.join(map(str, unknown_ids))}. Use IDs from the documents description."
+    document_ids, queries = list(dict.fromkeys(document_ids)), list(dict.fromkeys(filter(None, queries)))
+    if not document_ids or not queries:
+        return "ERROR: At least one document ID and one non-empty query are required."
+    found_documents = await hybrid_search(user.user_id, document_ids, queries,
+                                          k=settings.config.documents.search_best_k)
     logger.info(f"Found results: {found_documents}")
-    found_documents = [doc.page_content for doc in found_documents]
-    return {"found": found_documents}
+    # Chunks without a cached tokens count are tokenized, not on the event loop
+    return await asyncio.get_event_loop().run_in_executor(thread_pool, _select_found_chunks,
+                                                          document_ids, found_documents)
+
+
+def _select_found_chunks(document_ids: List[str], found_documents: dict) -> dict:
+    # Chunks are taken round-robin from the documents by relevance, so each document is represented within the budget
+    results = {document_id: [] for document_id in document_ids}
+    tokens_left = settings.config.documents.search_max_tokens
+    for chunks in itertools.zip_longest(*found_documents.values()):
+        for document_id, chunk in zip(found_documents.keys(), chunks):
+            if chunk is None:
+                continue
+            text, metadata = chunk
+            chunk_tokens = metadata.get('tokens_count') or len(long_context_model.tokenize_sentence(text))
+            if chunk_tokens > tokens_left:
+                continue
+            tokens_left -= chunk_tokens
+            results[document_id].append(text)
+    return {"found": [{"document_id": document_id, "texts": texts} for document_id, texts in results.items()]}
 
 
 def get_tokens_balance(user: UserEntity, current_user_data: dict):
@@ -69,13 +89,42 @@ FUNCTIONS_MAPPING: dict = {
 }
 
 
-def execute_function_call(user: UserEntity,
-                          current_user_data: dict,
-                          message: FunctionCallMessage) -> FunctionResponseMessage:
-    func_name = message.name
+async def _execute_tool_call(user: UserEntity, current_user_data: dict, tool_call: ToolCall):
+    """Async functions (network IO) run on the event loop, others in the thread pool"""
+    func_name = tool_call.name
     assert func_name in FUNCTIONS_MAPPING.keys(), f"Function '{func_name}' is not supported"
 
-    logger.info(f"Calling function '{func_name}' with args '{message.arguments}' for user '{user.user_id}'")
-    results = FUNCTIONS_MAPPING[func_name](user, current_user_data, **message.arguments)
+    logger.info(f"Calling function '{func_name}' with args '{tool_call.arguments}' for user '{user.user_id}'")
+    function = FUNCTIONS_MAPPING[func_name]
+    if asyncio.iscoroutinefunction(function):
+        return await function(user, current_user_data, **tool_call.arguments)
+    return await asyncio.get_event_loop().run_in_executor(thread_pool,
+                                                          functools.partial(function, user, current_user_data,
+                                                                            **tool_call.arguments))
 
-    return FunctionResponseMessage(tool_call_id=message.tool_call_id, text=json.dumps(results, ensure_ascii=False))
+
+async def _execute_tool_call_with_timeout(user: UserEntity, current_user_data: dict,
+                                          tool_call: ToolCall) -> FunctionResponseMessage:
+    # Every tool call must get a response, otherwise the model API rejects the history
+    try:
+        results = await asyncio.wait_for(_execute_tool_call(user, current_user_data, tool_call),
+                                         timeout=settings.config.function_call_timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Function '{tool_call.name}' timed out for user '{user.user_id}'")
+        results = "ERROR: The function took too long to execute."
+    except Exception as e:
+        logger.warning(f"Function '{tool_call.name}' failed for user '{user.user_id}': {e}")
+        results = "ERROR: The function failed to execute."
+    response = FunctionResponseMessage(role=ChatRole.FUNCTION, tool_call_id=tool_call.tool_call_id,
+                                       text=json.dumps(results, ensure_ascii=False))
+    # Responses can be long, they are tokenized in the thread pool
+    return await asyncio.get_event_loop().run_in_executor(thread_pool, cap_function_response,
+                                                          long_context_model, response)
+
+
+async def execute_function_call(user: UserEntity,
+                                current_user_data: dict,
+                                message: FunctionCallMessage) -> List[FunctionResponseMessage]:
+    """Executes all tool calls of the message concurrently, responses are in the same order as calls"""
+    return list(await asyncio.gather(*[_execute_tool_call_with_timeout(user, current_user_data, tool_call)
+                                       for tool_call in message.tool_calls]))
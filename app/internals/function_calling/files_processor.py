@@ -1,44 +1,68 @@
+import csv
+import functools
+import importlib
+import io
 import logging
-from typing import List
+import os
+import tempfile
+import time
+from typing import List, TYPE_CHECKING, Iterator, Iterable
 
 from aiogram.types import User
-from langchain.document_loaders import *
-from langchain.schema import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 from app import settings
 from app.bot import long_context_model
 from app.internals.chat.chat_history import ChatHistory, ChatMessage, ChatRole
 from app.internals.chat.chat_models import TextGenerationResult
+from app.internals.function_calling.hybrid_search import BM25Index, get_keyword_index_path
 from app.utils.misc import clean_text
 
+if TYPE_CHECKING:
+    from langchain.schema import Document
+    from app.internals.function_calling.token_splitter import TokenBudgetSplitter
+
 EXISTING_DOCUMENT_FORMAT = "- Document ID: {doc_id}. File name: '{file_name}'. Content summary: '{content_summary}'."
 
 SUMMARIZE_PROMPT = "You are given an excerpt of a document, your task is to determine what kind of document it is, topic the text is on, highlight the key words and make a brief summary of it. Answer in one text paragraph. The text is presented below:\n{content}"
 
+# Loaders are resolved by name on first use, langchain.document_loaders is a heavy import
 LOADER_MAPPING = {
-    ".csv": (CSVLoader, {}),
-    # ".docx": (Docx2txtLoader, {}),
-    ".doc": (UnstructuredWordDocumentLoader, {}),
-    ".docx": (UnstructuredWordDocumentLoader, {}),
-    ".enex": (EverNoteLoader, {}),
-    ".epub": (UnstructuredEPubLoader, {}),
-    ".html": (UnstructuredHTMLLoader, {}),
-    ".md": (UnstructuredMarkdownLoader, {}),
-    ".odt": (UnstructuredODTLoader, {}),
-    ".pdf": (PyMuPDFLoader, {}),
-    ".ppt": (UnstructuredPowerPointLoader, {}),
-    ".pptx": (UnstructuredPowerPointLoader, {}),
-    ".txt": (TextLoader, {"encoding": "utf8"}),
+    ".csv": ("CSVLoader", {}),
+    # ".docx": ("Docx2txtLoader", {}),
+    ".doc": ("UnstructuredWordDocumentLoader", {}),
+    ".docx": ("UnstructuredWordDocumentLoader", {}),
+    ".enex": ("EverNoteLoader", {}),
+    ".epub": ("UnstructuredEPubLoader", {}),
+    ".html": ("UnstructuredHTMLLoader", {}),
+    ".md": ("UnstructuredMarkdownLoader", {}),
+    ".odt": ("UnstructuredODTLoader", {}),
+    ".pdf": ("PyMuPDFLoader", {}),
+    ".ppt": ("UnstructuredPowerPointLoader", {}),
+    ".pptx": ("UnstructuredPowerPointLoader", {}),
+    ".txt": ("TextLoader", {"encoding": "utf8"}),
 }
 
 logger = logging.getLogger(__name__)
 
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=1_500, chunk_overlap=50)
 SUMMARY_DOCS = settings.config.documents.summary_blocks
 
 
-def make_summary(splits: List[Document], tg_user: User) -> str:
+@functools.lru_cache(maxsize=1)
+def get_text_splitter() -> 'TokenBudgetSplitter':
+    from app.internals.function_calling.token_splitter import TokenBudgetSplitter
+
+    # Chunks are measured in tokens of the model that reads search results
+    return TokenBudgetSplitter(model_name=settings.config.models.long_context.model_name,
+                               chunk_tokens=settings.config.documents.chunk_tokens,
+                               overlap_tokens=settings.config.documents.chunk_overlap_tokens)
+
+
+def get_loader_class(ext: str):
+    loader_name, _ = LOADER_MAPPING[ext]
+    return getattr(importlib.import_module('langchain.document_loaders'), loader_name)
+
+
+def make_summary(splits: List['Document'], tg_user: User) -> str:
     document_content = "\n".join([split.page_content for split in splits[:SUMMARY_DOCS]])
     prompt = SUMMARIZE_PROMPT.format(content=document_content)
     summary_hist = ChatHistory()  # No system prompt here
@@ -58,20 +82,122 @@ def check_if_extension_supported(file_path: str):
     return ext in LOADER_MAPPING
 
 
-def load_single_document(file_path: str, file_name: str, file_id: str) -> List[Document]:
-    ext = "." + file_path.rsplit(".", 1)[-1]
+def _iter_pdf_pages(file_path: str, file_name: str, data: bytes = None) -> Iterator['Document']:
+    import fitz
+    from langchain.schema import Document
+
+    with (fitz.open(stream=data, filetype='pdf') if data is not None else fitz.open(file_path)) as pdf:
+        for i, page in enumerate(pdf):
+            yield Document(page_content=page.get_text(),
+                           metadata={'source': file_name, 'page': i, 'total_pages': len(pdf)})
+
+
+def _iter_text_buffer(data: bytes, file_name: str) -> Iterator['Document']:
+    from langchain.schema import Document
 
-    loader_class, loader_args = LOADER_MAPPING[ext]
-    loader = loader_class(file_path, **loader_args)
-    documents = loader.load()
+    yield Document(page_content=data.decode('utf8'), metadata={'source': file_name})
 
-    splits: List[Document] = text_splitter.split_documents(documents)
-    for split in splits:
-        split.page_content = clean_text(split.page_content)
-        split.metadata['file_name'] = file_name
-        split.metadata['file_id'] = file_id
 
-    return splits
+def _iter_csv_buffer(data: bytes, file_name: str) -> Iterator['Document']:
+    from langchain.schema import Document
+
+    reader = csv.DictReader(io.StringIO(data.decode('utf-8-sig')))
+    for i, row in enumerate(reader):
+        yield Document(page_content="\n".join(f"{k.strip()}: {v.strip()}" for k, v in row.items()),
+                       metadata={'source': file_name, 'row': i})
+
+
+# Formats decoded straight from memory, others are written to a temp file for path-based loaders
+BUFFER_LOADERS_MAPPING = {
+    ".csv": _iter_csv_buffer,
+    ".txt": _iter_text_buffer,
+}
+
+
+def _iter_loader_pages(file_path: str) -> Iterator['Document']:
+    ext = "." + file_path.rsplit(".", 1)[-1]
+    _, loader_args = LOADER_MAPPING[ext]
+    loader = get_loader_class(ext)(file_path, **loader_args)
+    try:
+        pages = loader.lazy_load()
+    except NotImplementedError:  # not every langchain loader is lazy
+        pages = loader.load()
+    yield from pages
+
+
+def iter_document_pages(file_path: str, file_name: str, data: bytes = None) -> Iterator['Document']:
+    """
+    Yields document pages one by one, so the whole document is never materialized.
+    If 'data' is given, the document is decoded from memory and touches the disk only if the loader needs a path.
+    """
+    ext = "." + file_path.rsplit(".", 1)[-1]
+
+    if ext == ".pdf":
+        yield from _iter_pdf_pages(file_path, file_name, data)
+    elif data is None:
+        yield from _iter_loader_pages(file_path)
+    elif ext in BUFFER_LOADERS_MAPPING:
+        yield from BUFFER_LOADERS_MAPPING[ext](data, file_name)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = os.path.join(tmp_dir, "document" + ext)
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            yield from _iter_loader_pages(tmp_path)
+
+
+def iter_document_chunks(pages: Iterable['Document'], file_name: str, file_id: str) -> Iterator['Document']:
+    """Splits pages incrementally, chunks get sequential 'chunk_index' within the document and 'tokens_count'"""
+    from langchain.schema import Document
+
+    chunk_index = 0
+    for page in pages:
+        # Cleaned before splitting, so 'tokens_count' is the size of the stored text
+        for text, tokens_count in get_text_splitter().split_text(clean_text(page.page_content)):
+            yield Document(page_content=text,
+                           metadata={**page.metadata,
+                                     'file_name': file_name,
+                                     'file_id': file_id,
+                                     'chunk_index': chunk_index,
+                                     'tokens_count': tokens_count})
+            chunk_index += 1
+
+
+def load_single_document(file_path: str, file_name: str, file_id: str) -> List['Document']:
+    return list(iter_document_chunks(iter_document_pages(file_path, file_name), file_name, file_id))
+
+
+def stream_document_chunks(chunks_queue, user_id: int, file_path: str, file_name: str, file_id: str,
+                           data: bytes = None, batch_size: int = 64):
+    """
+    Process pool entry point: puts batches of chunks into the (bounded) queue as soon as they are ready,
+    then None as the end marker. Exception is put into the queue instead of the end marker.
+    BM25 keyword index of the document is built along the way and saved before the end marker.
+    Returns time spent on parsing and splitting in ms (without waiting for the queue).
+    """
+    parsing_time = 0.0
+    try:
+        batch = []
+        keyword_index = BM25Index()
+        chunks = iter_document_chunks(iter_document_pages(file_path, file_name, data), file_name, file_id)
+        while True:
+            start_time = time.time()
+            chunk = next(chunks, None)
+            parsing_time += time.time() - start_time
+            if chunk is None:
+                break
+            keyword_index.add(chunk.page_content, chunk.metadata)
+            batch.append(chunk)
+            if len(batch) == batch_size:
+                chunks_queue.put(batch)
+                batch = []
+        if batch:
+            chunks_queue.put(batch)
+        keyword_index.save(get_keyword_index_path(user_id, file_id))
+        chunks_queue.put(None)
+    except Exception as e:
+        chunks_queue.put(e)
+    return int(parsing_time * 1000)
 
 
 def build_document_info(file_id: str, file_name: str, file_summary: str) -> str:
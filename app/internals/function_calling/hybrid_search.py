@@ -0,0 +1,167 @@
+import asyncio
+import functools
+import json
+import logging
+import math
+import os
+import re
+import shutil
+from collections import Counter
+from typing import List, Tuple, Dict, Optional
+
+from app import settings
+from app.database.chroma_db_service import search_documents, embed_texts
+
+logger = logging.getLogger(__name__)
+
+WORDS_REGEXP = re.compile(r'\w+')
+COMPOUND_REGEXP = re.compile(r'\w+(?:[-./:#]\w+)+')  # IDs, versions, dates, codes
+RRF_K = 60  # standard reciprocal rank fusion constant
+FILE_ID_REGEXP = re.compile(r'[A-Za-z0-9_-]{1,64}')  # Telegram file_unique_id
+
+
+def tokenize(text: str) -> List[str]:
+    text = text.lower()
+    return WORDS_REGEXP.findall(text) + COMPOUND_REGEXP.findall(text)
+
+
+class BM25Index:
+    """
+    Okapi BM25 inverted index of a single document, rows are chunks in 'chunk_index' order.
+    Built incrementally during ingestion and saved as JSON to the directory of the user who has the document vectors.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}  # term -> [(row, term frequency)]
+        self.lengths: List[int] = []
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+
+    def add(self, text: str, metadata: dict):
+        row = len(self.texts)
+        terms = Counter(tokenize(text))
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, []).append((row, frequency))
+        self.lengths.append(sum(terms.values()))
+        self.texts.append(text)
+        self.metadatas.append(metadata)
+
+    def search(self, query: str, k: int) -> List[Tuple[str, dict]]:
+        rows_count = len(self.texts)
+        if rows_count == 0:
+            return []
+        average_length = sum(self.lengths) / rows_count
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (rows_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for row, frequency in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[row] / average_length)
+                scores[row] = scores.get(row, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        best_rows = sorted(scores, key=scores.get, reverse=True)[:k]
+        return [(self.texts[row], self.metadatas[row]) for row in best_rows]
+
+    def save(self, file_path: str):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as file:
+            json.dump({'k1': self.k1, 'b': self.b, 'postings': self.postings, 'lengths': self.lengths,
+                       'texts': self.texts, 'metadatas': self.metadatas}, file, ensure_ascii=False)
+        os.replace(tmp_path, file_path)  # readers never see a partially written index
+
+    @classmethod
+    def load(cls, file_path: str) -> 'BM25Index':
+        with open(file_path, encoding='utf8') as file:
+            data = json.load(file)
+        index = cls(k1=data['k1'], b=data['b'])
+        index.postings = {term: [tuple(posting) for posting in postings] for term, postings in data['postings'].items()}
+        index.lengths, index.texts, index.metadatas = data['lengths'], data['texts'], data['metadatas']
+        return index
+
+
+def check_file_id(file_id: str):
+    if not isinstance(file_id, str) or not FILE_ID_REGEXP.fullmatch(file_id):
+        raise ValueError(f"Invalid document id: {file_id!r}")
+
+
+def get_keyword_index_path(user_id: int, file_id: str) -> str:
+    check_file_id(file_id)
+    return os.path.join(settings.config.documents.keyword_index_dir, str(int(user_id)), f"{file_id}.json")
+
+
+@functools.lru_cache(maxsize=64)
+def _load_keyword_index(file_path: str, modified_time: float) -> BM25Index:
+    return BM25Index.load(file_path)
+
+
+def get_keyword_index(user_id: int, file_id: str) -> Optional[BM25Index]:
+    """Indexes are kept per user like vectors, so a user can search only in own documents"""
+    file_path = get_keyword_index_path(user_id, file_id)
+    try:
+        return _load_keyword_index(file_path, os.path.getmtime(file_path))
+    except FileNotFoundError:
+        return None
+
+
+def copy_keyword_index(source_user_id: int, user_id: int, file_id: str):
+    """Attaches the index of an already indexed document together with its vectors"""
+    source_path = get_keyword_index_path(source_user_id, file_id)
+    target_path = get_keyword_index_path(user_id, file_id)
+    if source_path == target_path or not os.path.exists(source_path):
+        return
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    shutil.copyfile(source_path, target_path + '.tmp')
+    os.replace(target_path + '.tmp', target_path)
+
+
+def delete_keyword_indexes(user_id: int):
+    shutil.rmtree(os.path.join(settings.config.documents.keyword_index_dir, str(int(user_id))), ignore_errors=True)
+
+
+def clear_keyword_indexes():
+    shutil.rmtree(settings.config.documents.keyword_index_dir, ignore_errors=True)
+
+
+def reciprocal_rank_fusion(rankings: List[List[Tuple[str, dict]]], k: int) -> List[Tuple[str, dict]]:
+    """Merges ranked lists of chunks by sum of 1 / (RRF_K + rank), chunks are matched by 'file_id' and 'chunk_index'"""
+    scores, chunks = {}, {}
+    for ranking in rankings:
+        for rank, (text, metadata) in enumerate(ranking):
+            key = (metadata.get('file_id'), metadata['chunk_index']) if 'chunk_index' in metadata else text
+            scores[key] = scores.get(key, 0.0) + 1 / (RRF_K + rank + 1)
+            chunks.setdefault(key, (text, metadata))
+    return [chunks[key] for key in sorted(scores, key=scores.get, reverse=True)[:k]]
+
+
+def _search_document(user_id: int, file_id: str, queries: List[str], queries_embeddings: List[List[float]],
+                     k: int) -> List[Tuple[str, dict]]:
+    candidates_count = max(k, settings.config.documents.hybrid_candidates)
+    rankings = search_documents(user_id, file_id, queries_embeddings, candidates_count)
+    keyword_index = get_keyword_index(user_id, file_id)
+    if keyword_index is not None:  # documents indexed before keyword search have vectors only
+        rankings += [keyword_index.search(query, candidates_count) for query in queries]
+    return reciprocal_rank_fusion(rankings, k)
+
+
+async def hybrid_search(user_id: int, file_ids: List[str], queries: List[str],
+                        k: int) -> Dict[str, List[Tuple[str, dict]]]:
+    """
+    Vector search merged with BM25 keyword search, so exact IDs, names and numbers are found too.
+    Every query is searched in every document: queries are embedded in one batch, documents are searched concurrently,
+    and rankings of all queries are fused into top 'k' unique chunks per document.
+    Runs on the event loop and fans out to the thread pool, pool workers never wait for their own subtasks.
+    """
+    from app.bot import thread_pool
+
+    if not file_ids or not queries:
+        raise ValueError("At least one document and one query are needed")
+    loop = asyncio.get_event_loop()
+    queries_embeddings = await loop.run_in_executor(thread_pool, embed_texts, queries)
+    found = await asyncio.gather(*[loop.run_in_executor(thread_pool, _search_document, user_id, file_id,
+                                                        queries, queries_embeddings, k)
+                                   for file_id in file_ids])
+    return dict(zip(file_ids, found))
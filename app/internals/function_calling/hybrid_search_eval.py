@@ -0,0 +1,109 @@
+"""
+Retrieval quality of vector, keyword (BM25) and hybrid search on a small fixture corpus.
+
+Usage: python -m app.internals.function_calling.hybrid_search_eval [--k 8]
+
+Embeddings are requested from the configured embeddings model (through the embeddings cache),
+vectors are kept in a temporary local vector store.
+A question whose answer chunk is not in top-k usually costs one more 'search_in_document_query' call,
+so misses are reported as extra tool round trips.
+"""
+import argparse
+import random
+import shutil
+import tempfile
+
+from app.database.chroma_db_service import embed_texts
+from app.database.vector_stores import LocalVectorStore
+from app.internals.function_calling.hybrid_search import BM25Index, reciprocal_rank_fusion
+
+FILE_ID = 'fixture'
+FILLER_CHUNKS = 120  # similar looking chunks, so the answer chunk has competition
+
+# (chunk text, question answered only by this chunk)
+FIXTURE = [
+    ("Invoice INV-2023-0457 was issued to Northwind Traders on 14.03.2023 for 12 400 EUR, payment terms net 30.",
+     "What is the amount of invoice INV-2023-0457?"),
+    ("Invoice INV-2023-0458 was issued to Contoso Ltd on 15.03.2023 for 8 150 EUR, payment terms net 45.",
+     "Who received invoice INV-2023-0458?"),
+    ("Serial number SN-88A1-4420 belongs to the replacement compressor installed in building B, floor 3.",
+     "Where is the device with serial SN-88A1-4420 installed?"),
+    ("The firmware v2.14.3 fixes the watchdog reset loop reported in ticket OPS-1192.",
+     "Which firmware version fixes OPS-1192?"),
+    ("Dr. Eleanor Vasquez leads the cardiology department and approves all equipment purchases above 5 000 EUR.",
+     "Who is Eleanor Vasquez?"),
+    ("Contract clause 7.4.2 allows either party to terminate the agreement with 90 days written notice.",
+     "What does clause 7.4.2 say?"),
+    ("Part 3321-B is a stainless steel flange rated for 16 bar, compatible with pipe diameter 50 mm.",
+     "What pressure is part 3321-B rated for?"),
+    ("Order #55102 was shipped via DHL with tracking code JD014600006281234567 on April 2nd.",
+     "What is the tracking code of order #55102?"),
+    ("Employees hired after 01.07.2022 accrue 24 vacation days per year, earlier hires keep 28 days.",
+     "How many vacation days do employees hired after 01.07.2022 get?"),
+    ("The warehouse in Rotterdam (code NL-RTM-02) handles all returns from the Benelux region.",
+     "Which warehouse has code NL-RTM-02?"),
+    ("Project Falcon's budget was cut from 1.2M to 950k USD after the Q3 review.",
+     "What happened to Project Falcon budget?"),
+    ("API key rotation is performed every 45 days by the platform team using the vault-rotate job.",
+     "How often are API keys rotated?"),
+    ("The quarterly revenue grew because of strong demand in the enterprise segment and lower churn.",
+     "Why did the quarterly revenue grow?"),
+    ("Safety training is mandatory for all staff working with chemicals and must be renewed annually.",
+     "Who has to attend safety training?"),
+]
+
+FILLER_TOPICS = ['invoice', 'order', 'contract', 'firmware', 'warehouse', 'project', 'employees', 'part']
+
+
+def _make_corpus(seed: int = 0):
+    rng = random.Random(seed)
+    texts = [text for text, _ in FIXTURE]
+    for i in range(FILLER_CHUNKS):
+        topic = rng.choice(FILLER_TOPICS)
+        texts.append(f"This section describes the general {topic} process. Each {topic} is reviewed by the "
+                     f"responsible team, record {rng.randint(1000, 9999)} is kept for {rng.randint(2, 10)} years "
+                     f"and reported on {rng.randint(1, 28)}.{rng.randint(1, 12)}.")
+    rng.shuffle(texts)
+    metadatas = [{'file_id': FILE_ID, 'chunk_index': i} for i in range(len(texts))]
+    return texts, metadatas
+
+
+def run_evaluation(k: int):
+    texts, metadatas = _make_corpus()
+    answers = {text: i for i, text in enumerate(texts)}
+    questions = [(question, answers[text]) for text, question in FIXTURE]
+
+    keyword_index = BM25Index()
+    for text, metadata in zip(texts, metadatas):
+        keyword_index.add(text, metadata)
+
+    store_dir = tempfile.mkdtemp(prefix='hybrid_eval_')
+    try:
+        vector_store = LocalVectorStore(store_dir, max_loaded_users=1)
+        vector_store.add(0, embed_texts(texts), texts, metadatas)
+        queries_embeddings = embed_texts([question for question, _ in questions])
+
+        misses = {'vector': 0, 'keyword': 0, 'hybrid': 0}
+        for (question, answer_index), embedding in zip(questions, queries_embeddings):
+            vector_found = vector_store.query(0, FILE_ID, [embedding], max(k, 20))[0]
+            keyword_found = keyword_index.search(question, max(k, 20))
+            found = {'vector': vector_found[:k],
+                     'keyword': keyword_found[:k],
+                     'hybrid': reciprocal_rank_fusion([vector_found, keyword_found], k)}
+            for method, method_found in found.items():
+                if answer_index not in [metadata['chunk_index'] for _, metadata in method_found]:
+                    misses[method] += 1
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+    print(f"{len(texts)} chunks, {len(questions)} questions, k {k}")
+    print(f"{'method':<8} {'recall@k':>9} {'extra round trips':>18}")
+    for method, method_misses in misses.items():
+        print(f"{method:<8} {1 - method_misses / len(questions):>9.3f} {method_misses:>18}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--k', type=int, default=8)
+    args = parser.parse_args()
+    run_evaluation(args.k)
@@ -0,0 +1,185 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import queue
+import time
+import typing
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from multiprocessing.managers import SyncManager
+from typing import List, TYPE_CHECKING
+
+from app import settings
+from app.bot import thread_pool, get_process_pool, replace_broken_process_pool
+from app.database.chroma_db_service import embed_texts, add_embedded_documents, get_embeddings_cache, \
+    begin_user_vectors_write, end_user_vectors_write
+from app.internals.function_calling.files_processor import stream_document_chunks
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+logger = logging.getLogger(__name__)
+
+QUEUE_POLL_TIMEOUT = 1.0  # in seconds, the parsing worker is checked between waits for chunks
+
+_queues_manager: SyncManager = None
+
+
+def get_queues_manager() -> SyncManager:
+    """Manager of queues shared with process pool workers, started on bot startup before other threads"""
+    global _queues_manager
+    if _queues_manager is None:
+        _queues_manager = multiprocessing.Manager()
+    return _queues_manager
+
+
+async def _next_batch(chunks_queue, parsing_task: asyncio.Future):
+    """
+    Waits for the next item from the worker without blocking a pool thread forever:
+    if the worker process died (OOM, broken pool), nothing will be put into the queue.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            return await loop.run_in_executor(thread_pool, functools.partial(chunks_queue.get,
+                                                                             timeout=QUEUE_POLL_TIMEOUT))
+        except queue.Empty:
+            # The worker puts all items before it returns, so a finished worker with an empty queue sent everything
+            if parsing_task.done():
+                if not parsing_task.cancelled() and parsing_task.exception() is not None:
+                    raise parsing_task.exception()
+                raise RuntimeError("Document parsing worker stopped without the end marker")
+
+
+async def _drain_queue(chunks_queue, parsing_task: asyncio.Future):
+    # Unblocks the worker after a failure, so the process returns to the pool
+    try:
+        item = await _next_batch(chunks_queue, parsing_task)
+        while item is not None and not isinstance(item, Exception):
+            item = await _next_batch(chunks_queue, parsing_task)
+    except Exception as e:
+        logger.debug(f"Chunks queue drained, worker stopped: {e}")
+
+
+@dataclass
+class IngestionReport:
+    file_id: str
+    chunks_count: int = 0
+    batches_count: int = 0
+    stages_time: typing.Dict[str, int] = field(default_factory=dict)  # in ms, summed over batches
+
+    def add_time(self, stage: str, start_time: float):
+        self.stages_time[stage] = self.stages_time.get(stage, 0) + int((time.time() - start_time) * 1000)
+
+    def __str__(self):
+        stages = ", ".join(f"{stage}: {ms} ms" for stage, ms in self.stages_time.items())
+        return f"file '{self.file_id}', chunks: {self.chunks_count}, batches: {self.batches_count}, {stages}"
+
+
+async def ingest_document(user_id: int,
+                          file_path: str,
+                          file_name: str,
+                          file_id: str,
+                          data: bytes = None,
+                          first_chunks_count: int = 0,
+                          on_first_chunks: typing.Callable[[List['Document']], typing.Any] = None,
+                          on_progress: typing.Callable[[int], typing.Awaitable] = None
+                          ) -> IngestionReport:
+    """
+    Streaming document ingestion off the event loop:
+    1) Pages are parsed, split and cleaned one by one in the process pool (CPU bound, holds the GIL)
+    2) Chunks come back in batches through a bounded queue, the worker pauses when embedding falls behind
+    3) Every batch is embedded in the thread pool (IO bound, concurrently) and inserted into user index right away
+
+    Chunks are never accumulated, so peak memory does not depend on the document size.
+    'on_first_chunks' is called once the first 'first_chunks_count' chunks are ready (e.g. to start a summary).
+    If 'data' is given, the document is parsed from memory, otherwise it is read from 'file_path'.
+    """
+    loop = asyncio.get_event_loop()
+    report = IngestionReport(file_id=file_id)
+    total_start = time.time()
+    write_started = loop.run_in_executor(thread_pool, begin_user_vectors_write, user_id)
+    try:
+        await asyncio.shield(write_started)
+    except asyncio.CancelledError:
+        write_started.add_done_callback(lambda _: end_user_vectors_write(user_id))
+        raise
+    try:
+        concurrency = settings.config.documents.embeddings_concurrency
+        semaphore = asyncio.Semaphore(concurrency)
+        chunks_queue = get_queues_manager().Queue(maxsize=concurrency)
+        parsing_args = (stream_document_chunks, chunks_queue, user_id, file_path, file_name, file_id, data,
+                        settings.config.documents.embeddings_batch_size)
+        process_pool = get_process_pool()
+        try:
+            parsing_task = loop.run_in_executor(process_pool, *parsing_args)
+        except BrokenProcessPool:  # broken by a previous document, nothing was parsed yet
+            process_pool = replace_broken_process_pool(process_pool)
+            parsing_task = loop.run_in_executor(process_pool, *parsing_args)
+
+        first_chunks: List['Document'] = []
+        batches_tasks = []
+        processed_count = 0
+        queue_finished = False
+
+        async def process_batch(batch: List['Document']):
+            nonlocal processed_count
+            try:
+                batch_start = time.time()
+                embeddings = await loop.run_in_executor(thread_pool, embed_texts,
+                                                        [split.page_content for split in batch])
+                report.add_time('embedding', batch_start)
+
+                batch_start = time.time()
+                await loop.run_in_executor(thread_pool, add_embedded_documents, user_id, batch, embeddings)
+                report.add_time('inserting', batch_start)
+            finally:
+                semaphore.release()
+
+            processed_count += len(batch)
+            if on_progress is not None:
+                await on_progress(processed_count)
+
+        try:
+            while True:
+                await semaphore.acquire()  # no more than 'concurrency' batches are held in memory
+                waiting_start = time.time()
+                batch = await _next_batch(chunks_queue, parsing_task)
+                report.add_time('waiting_chunks', waiting_start)
+                if batch is None or isinstance(batch, Exception):
+                    queue_finished = True
+                    semaphore.release()
+                    if isinstance(batch, Exception):
+                        raise batch
+                    break
+
+                if on_first_chunks is not None and len(first_chunks) < first_chunks_count:
+                    first_chunks.extend(batch[:first_chunks_count - len(first_chunks)])
+                    if len(first_chunks) == first_chunks_count:
+                        on_first_chunks(first_chunks)
+
+                report.chunks_count += len(batch)
+                report.batches_count += 1
+                batches_tasks.append(asyncio.create_task(process_batch(batch)))
+
+            # Document is shorter than needed for the summary
+            if on_first_chunks is not None and 0 < len(first_chunks) < first_chunks_count:
+                on_first_chunks(first_chunks)
+
+            report.stages_time['parsing'] = await parsing_task
+            await asyncio.gather(*batches_tasks)
+        except BaseException as e:
+            for task in batches_tasks:
+                task.cancel()
+            if not queue_finished:
+                asyncio.ensure_future(_drain_queue(chunks_queue, parsing_task))
+            if isinstance(e, BrokenProcessPool):  # only this document fails, next ones get a new pool
+                replace_broken_process_pool(process_pool)
+            raise
+
+        report.add_time('total', total_start)
+        logger.info(f"Document ingested: {report}. Embeddings cache: {get_embeddings_cache().stats()}")
+        return report
+    finally:
+        end_user_vectors_write(user_id)
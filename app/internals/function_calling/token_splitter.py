@@ -0,0 +1,96 @@
+import functools
+from typing import List, Tuple
+
+import numpy as np
+import tiktoken
+
+# Levels of a cut after a token, the splitter cuts at the strongest boundary in the allowed window
+UNSAFE, NONE, WORD, SENTENCE, LINE, PARAGRAPH = -1, 0, 1, 2, 3, 4
+
+SENTENCE_ENDS = (b'.', b'!', b'?', b';', b':')
+SPACES = (b' ', b'\n', b'\t')
+
+
+@functools.lru_cache(maxsize=4)
+def _vocabulary_tables(encoding_name: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Per-token lookup tables over the whole vocabulary, built once per process:
+    - level of a boundary right after the token (by its trailing bytes)
+    - whether the token starts with whitespace (a word starts before it)
+    - whether the token starts inside a multibyte UTF-8 character (a cut before it would break the character)
+    """
+    encoding = tiktoken.get_encoding(encoding_name)
+    vocabulary_size = encoding.max_token_value + 1
+    end_levels = np.full(vocabulary_size, NONE, dtype=np.int8)
+    space_starts = np.zeros(vocabulary_size, dtype=bool)
+    continuation_starts = np.zeros(vocabulary_size, dtype=bool)
+    for token in range(vocabulary_size):
+        try:
+            token_bytes = encoding.decode_single_token_bytes(token)
+        except KeyError:  # gaps between regular and special tokens
+            continue
+        if not token_bytes:
+            continue
+        if token_bytes.endswith(b'\n\n'):
+            end_levels[token] = PARAGRAPH
+        elif token_bytes.endswith(b'\n'):
+            end_levels[token] = LINE
+        elif token_bytes.rstrip(b' \t').endswith(SENTENCE_ENDS):
+            end_levels[token] = SENTENCE
+        space_starts[token] = token_bytes[:1] in SPACES
+        continuation_starts[token] = 0x80 <= token_bytes[0] <= 0xBF
+    return end_levels, space_starts, continuation_starts
+
+
+class TokenBudgetSplitter:
+    """
+    Splits text into chunks of at most 'chunk_tokens' tokens of the model encoding, with 'overlap_tokens' overlap.
+    The text is tokenized once, boundary levels of all tokens are computed with vectorized table lookups,
+    and every chunk ends at the strongest boundary (paragraph > line > sentence > word) in its second half.
+    """
+
+    def __init__(self, model_name: str, chunk_tokens: int, overlap_tokens: int):
+        assert 0 <= overlap_tokens < chunk_tokens // 2, "Overlap must be less than a half of the chunk"
+        self.encoding = tiktoken.encoding_for_model(model_name)
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+
+    def _cut_levels(self, tokens: np.ndarray) -> np.ndarray:
+        """Level of a cut after every token"""
+        end_levels, space_starts, continuation_starts = _vocabulary_tables(self.encoding.name)
+        levels = end_levels[tokens]
+        next_tokens = tokens[1:]
+        levels[:-1] = np.where(space_starts[next_tokens], np.maximum(levels[:-1], WORD), levels[:-1])
+        levels[:-1][continuation_starts[next_tokens]] = UNSAFE
+        levels[-1] = PARAGRAPH
+        return levels
+
+    def split_text(self, text: str) -> List[Tuple[str, int]]:
+        """Returns chunks texts with their tokens count"""
+        tokens = np.asarray(self.encoding.encode(text, disallowed_special=()), dtype=np.int64)
+        if len(tokens) == 0:
+            return []
+        levels = self._cut_levels(tokens)
+        min_tokens = self.chunk_tokens // 2
+
+        chunks = []
+        start = 0
+        while True:
+            end = min(start + self.chunk_tokens, len(tokens))
+            if end < len(tokens):
+                window = levels[start + min_tokens - 1:end]
+                end = start + min_tokens + int(np.flatnonzero(window == window.max())[-1])
+            chunks.append((self.encoding.decode(tokens[start:end].tolist()), end - start))
+            if end == len(tokens):
+                return chunks
+
+            # Overlap starts at a word beginning if there is one, and never breaks a character
+            overlap_levels = levels[end - self.overlap_tokens - 1:end - 1]
+            word_starts = np.flatnonzero(overlap_levels >= WORD)
+            safe_starts = np.flatnonzero(overlap_levels > UNSAFE)
+            if len(word_starts):
+                start = end - self.overlap_tokens + int(word_starts[0])
+            elif len(safe_starts):
+                start = end - self.overlap_tokens + int(safe_starts[0])
+            else:
+                start = end
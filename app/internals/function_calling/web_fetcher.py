@@ -0,0 +1,175 @@
+import asyncio
+import codecs
+import functools
+import logging
+import time
+from typing import Optional, TYPE_CHECKING
+
+from app import settings
+from app.bot import thread_pool
+from app.database.web_pages_cache import WebPagesCache, normalize_url
+from app.settings import WebFetcherConfig
+from app.utils.misc import clean_text
+
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 64 * 1024
+SUPPORTED_CONTENT_TYPES = ['text/html', 'text/plain', 'application/xhtml+xml']
+BLOCKED_STATUSES = [401, 403, 429, 451, 503]  # typical answers of bot protections
+NEGATIVE_CACHED_STATUSES = [401, 403, 451]  # 429 and 503 are temporary, they are not cached
+
+
+class PageTooLongError(Exception):
+    pass
+
+
+class PageBlockedError(Exception):
+    pass
+
+
+class WebFetcher:
+    """
+    Shared HTTP client for web pages: one connection pool with DNS cache for all users.
+    Body is read in chunks and converted to text as it arrives, so too long pages are dropped
+    as soon as 'max_bytes' or 'max_chars' is exceeded, without downloading the rest.
+
+    Texts are cached by normalized URL. After 'cache_ttl' a page is revalidated with a conditional request
+    (If-None-Match / If-Modified-Since), too long and blocked pages are remembered for 'cache_negative_ttl'.
+    Cache is on disk, its calls are made in the thread pool.
+    """
+
+    def __init__(self, config: WebFetcherConfig):
+        self.config = config
+        self.cache = WebPagesCache(config.cache_path, config.cache_max_bytes)
+        self._session: Optional['aiohttp.ClientSession'] = None
+
+    def _default_headers(self) -> dict:
+        try:
+            from fake_useragent import UserAgent
+
+            user_agent = UserAgent().random
+        except Exception:
+            user_agent = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+        return {
+            'User-Agent': user_agent,
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en-US,en;q=0.5',
+            'Connection': 'keep-alive',
+        }
+
+    def get_session(self) -> 'aiohttp.ClientSession':
+        # Created on first use inside the running event loop
+        import aiohttp
+
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.config.connections_limit,
+                                             limit_per_host=self.config.connections_per_host,
+                                             use_dns_cache=True,
+                                             ttl_dns_cache=self.config.dns_cache_ttl)
+            timeout = aiohttp.ClientTimeout(total=self.config.total_timeout,
+                                            sock_connect=self.config.connect_timeout,
+                                            sock_read=self.config.read_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                                  headers=self._default_headers())
+        return self._session
+
+    async def _run_in_cache(self, method, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(thread_pool,
+                                                              functools.partial(method, *args, **kwargs))
+
+    async def fetch_text(self, url: str) -> str:
+        """
+        Returns page content converted to text.
+        Raises PageTooLongError if the page exceeds the limits, PageBlockedError if the site refuses bots.
+        """
+        import aiohttp
+
+        cache_key = normalize_url(url)
+        entry = await self._run_in_cache(self.cache.get, cache_key)
+        headers = {}
+        if entry is not None:
+            age = time.time() - entry['fetched_at']
+            if entry['error'] is not None and age < self.config.cache_negative_ttl:
+                self.cache.hits += 1
+                raise PageTooLongError("Cached") if entry['error'] == 'too_long' else PageBlockedError("Cached")
+            if entry['error'] is None:
+                if age < self.config.cache_ttl:
+                    self.cache.hits += 1
+                    return entry['text']
+                if entry['etag']:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['last_modified']:
+                    headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            async with self.get_session().get(url, headers=headers, max_redirects=self.config.max_redirects) as response:
+                if response.status == 304 and headers:
+                    self.cache.revalidated += 1
+                    await self._run_in_cache(self.cache.touch, cache_key)
+                    return entry['text']
+                self.cache.misses += 1
+                response.raise_for_status()
+                text = await self._read_text(response)
+                if 'no-store' not in response.headers.get('Cache-Control', ''):
+                    await self._run_in_cache(self.cache.put, cache_key, text,
+                                             etag=response.headers.get('ETag'),
+                                             last_modified=response.headers.get('Last-Modified'))
+                return text
+        except PageTooLongError:
+            await self._run_in_cache(self.cache.put_error, cache_key, 'too_long')
+            raise
+        except aiohttp.ClientResponseError as e:
+            if e.status in BLOCKED_STATUSES:
+                if e.status in NEGATIVE_CACHED_STATUSES:
+                    await self._run_in_cache(self.cache.put_error, cache_key, 'blocked')
+                raise PageBlockedError(f"Status {e.status}") from e
+            raise
+
+    async def _read_text(self, response: 'aiohttp.ClientResponse') -> str:
+        import html2text
+
+        if response.content_type not in SUPPORTED_CONTENT_TYPES:
+            raise ValueError(f"Unsupported content type: {response.content_type}")
+        if response.content_length is not None and response.content_length > self.config.max_bytes:
+            raise PageTooLongError(f"Content length {response.content_length} exceeds the limit")
+
+        decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+        converter = html2text.HTML2Text()
+        converter.ignore_links = True
+        converter.ignore_images = True
+
+        bytes_read = chars_count = converted_parts = 0
+        async for data in response.content.iter_chunked(READ_CHUNK_SIZE):
+            bytes_read += len(data)
+            if bytes_read > self.config.max_bytes:
+                raise PageTooLongError(f"Page is bigger than {self.config.max_bytes} bytes")
+            converter.feed(decoder.decode(data))
+            # Only new output parts are counted, html2text appends them to 'outtextlist'
+            chars_count += sum(len(part) for part in converter.outtextlist[converted_parts:])
+            converted_parts = len(converter.outtextlist)
+            if chars_count > self.config.max_chars:
+                raise PageTooLongError(f"Page text is longer than {self.config.max_chars} characters")
+        converter.feed(decoder.decode(b'', final=True))
+
+        text = clean_text(converter.finish())
+        if len(text) > self.config.max_chars:
+            raise PageTooLongError(f"Page text is longer than {self.config.max_chars} characters")
+        return text
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            await asyncio.sleep(0.25)  # lets SSL connections close gracefully
+
+
+_web_fetcher: Optional[WebFetcher] = None
+
+
+def get_web_fetcher() -> WebFetcher:
+    global _web_fetcher
+    if _web_fetcher is None:
+        _web_fetcher = WebFetcher(settings.config.web_fetcher)
+    return _web_fetcher
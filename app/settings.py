@@ -1,6 +1,6 @@
 import json
 import logging
-from typing import List, Dict
+from typing import List, Dict, Callable
 
 from pydantic import BaseModel
 
@@ -13,11 +13,74 @@ logger = logging.getLogger(__name__)
 class DocumentsConfig(BaseModel):
     summary_blocks: int
     search_best_k: int
+    hybrid_candidates: int  # from each of vector and keyword search, before the fusion
+    search_max_tokens: int  # budget of all found chunks in a single search response
+    chunk_tokens: int  # max chunk size in tokens of the long context model
+    chunk_overlap_tokens: int
+    keyword_index_dir: str
+    in_memory_max_size: int  # in bytes, bigger files are downloaded to a temp dir
+    ingestion_workers: int  # processes for parsing and splitting
+    embeddings_batch_size: int
+    embeddings_concurrency: int
+
+
+class HistorySummaryConfig(BaseModel):
+    enabled: bool
+    target_tokens: int  # history over it is folded into the summary, down to a half of it
+    keep_last_messages: int  # never folded
+
+
+class ModelRouterConfig(BaseModel):
+    window: int  # in seconds, outcomes of requests to a model kept for its circuit breaker
+    min_requests: int  # in the window to judge a model
+    error_rate_threshold: float  # circuit is opened at this share of failed requests
+    slow_p90: float  # in seconds, circuit is also opened if 90th percentile of latency is above it
+    open_duration: int  # in seconds, before a probe request
+    request_timeout: int  # in seconds, for one request to the API
+
+
+class GenerationSchedulerConfig(BaseModel):
+    max_in_flight: int  # generations sent to the API at once
+    per_user_in_flight: int
+    quantum_tokens: int  # share of a user per round, multiplied by the package level + 1
+
+
+class FunctionResponsesConfig(BaseModel):
+    max_tokens: int  # each tool result is truncated to it when created
+    stale_after_turns: int  # user turns after which tool results are replaced with stubs
+
+
+class WebFetcherConfig(BaseModel):
+    connect_timeout: float  # in seconds
+    read_timeout: float  # in seconds, between body chunks
+    total_timeout: float  # in seconds
+    connections_limit: int
+    connections_per_host: int
+    dns_cache_ttl: int  # in seconds
+    max_redirects: int
+    max_bytes: int  # page download stops after this size
+    max_chars: int  # page text length limit
+    cache_path: str  # sqlite file of pages texts
+    cache_max_bytes: int
+    cache_ttl: int  # in seconds, pages are revalidated after it
+    cache_negative_ttl: int  # in seconds, for too long pages and sites blocking bots
+
+
+class VectorStoreConfig(BaseModel):
+    backend: str  # 'chroma' or 'local'
+    local_dir: str  # vectors of 'local' backend
+    shards: int  # count of shared collections
+    gc_interval: int  # in seconds, removal of ended sessions vectors
+    clear_on_startup: bool
 
 
 class BlipConfig(BaseModel):
     use_large: bool
     device: str
+    backend: str  # 'torch', 'int8' or 'onnx'
+    onnx_dir: str
+    num_beams: int
+    fast_tier_load: int  # in-flight captioning requests after which greedy decoding is used
 
 
 class BlipGptPrompts(BaseModel):
@@ -30,6 +93,9 @@ class EmbeddingsModelConfig(BaseModel):
     model_name: str
     max_retries: int
     embedding_ctx_length: int
+    cache_dir: str
+    cache_dtype: str  # 'float16' or 'float32'
+    cache_max_entries: int
 
 
 class ModelConfig(BaseModel):
@@ -37,6 +103,8 @@ class ModelConfig(BaseModel):
     max_context_size: int
     model_name: str
     tokens_scale: float
+    requests_per_minute: int  # rate limits of the API key for the model
+    tokens_per_minute: int
     generation_params: dict
 
 
@@ -57,6 +125,7 @@ class BotConfig(BaseModel):
     embeddings_model: EmbeddingsModelConfig
     models: ModelsConfig
     last_messages_count: int
+    history_reserve_messages: int  # kept in memory beyond last_messages_count, until folded into the summary
     global_mode: bool
     free_mode: bool
     tokens_packages: TokensPackagesConfig
@@ -65,7 +134,15 @@ class BotConfig(BaseModel):
     instant_messages_waiting: int
     append_tokens_count: bool
     openai_api_retries: int
+    function_call_timeout: int  # in seconds, for each tool call
+    max_tool_rounds: int  # generations with function calls per user message, the next one is forced to be text
+    function_responses: FunctionResponsesConfig
+    history_summary: HistorySummaryConfig
+    model_router: ModelRouterConfig
+    generation_scheduler: GenerationSchedulerConfig
     documents: DocumentsConfig
+    vector_store: VectorStoreConfig
+    web_fetcher: WebFetcherConfig
     blip: BlipConfig
     blip_gpt_prompts: BlipGptPrompts
 
@@ -108,6 +185,7 @@ class Documents(BaseModel):
     not_allowed: Dict[str, str]
     not_supported: Dict[str, str]
     loading: Dict[str, str]
+    progress: Dict[str, str]
     loaded: Dict[str, str]
 
 
@@ -221,10 +299,15 @@ class BotSettings:
     _PERSONALITIES_PATH = 'resources/personalities.json'
     _MESSAGES_PATH = 'resources/messages.json'
     _TOKENS_PACKAGES_PATH = 'resources/tokens_packages.json'
+    _RELOAD_LISTENERS: List[Callable[[], None]] = []
 
     def __init__(self):
         self.load()
 
+    def add_reload_listener(self, listener: Callable[[], None]):
+        """Listener rebuilds data derived from configs, it is called after each load"""
+        self._RELOAD_LISTENERS.append(listener)
+
     @property
     def config(self) -> BotConfig:
         return self._CONFIGS_MAP['config']
@@ -258,6 +341,8 @@ class BotSettings:
             _tokens_packages = {k: TokensPackageConfig(**v) for k, v in _tokens_packages.items()}
             self._CONFIGS_MAP['tokens_packages'] = _tokens_packages
             logger.info(f"Tokens packages config loaded. Types: {list(self.tokens_packages.keys())}")
+        for listener in self._RELOAD_LISTENERS:
+            listener()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,61 @@
+"""
+Import-time profile of the bot, based on `python -X importtime`.
+
+Usage: python -m app.utils.import_profiler [module ...] [--top N]
+
+By default profiles 'main' imports (everything needed before polling starts)
+and prints the slowest modules by cumulative and self time, plus totals per top-level package.
+"""
+import argparse
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+
+def profile_imports(modules: list) -> list:
+    """Returns list of (module, self_us, cumulative_us, depth) in import order"""
+    code = '; '.join(f'import {module}' for module in modules)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             capture_output=True, text=True)
+    if process.returncode != 0:
+        print(process.stderr.splitlines()[-1], file=sys.stderr)
+
+    records = []
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, module = match.groups()
+        records.append((module, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return records
+
+
+def print_report(records: list, top: int):
+    total_us = sum(record[2] for record in records if record[3] == 0)
+    print(f"Total import time: {total_us / 1e6:.3f}s, modules imported: {len(records)}\n")
+
+    print(f"Top {top} by cumulative time:")
+    for module, _, cumulative_us, depth in sorted(records, key=lambda x: -x[2])[:top]:
+        print(f"  {cumulative_us / 1e3:>10.1f} ms  {module} (depth {depth})")
+
+    print(f"\nTop {top} by self time:")
+    for module, self_us, _, _ in sorted(records, key=lambda x: -x[1])[:top]:
+        print(f"  {self_us / 1e3:>10.1f} ms  {module}")
+
+    packages = defaultdict(int)
+    for module, self_us, _, _ in records:
+        packages[module.split('.')[0]] += self_us
+    print(f"\nTop {top} packages by total self time:")
+    for package, self_us in sorted(packages.items(), key=lambda x: -x[1])[:top]:
+        print(f"  {self_us / 1e3:>10.1f} ms  {package} ({self_us * 100 / (total_us or 1):.1f}%)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=['main'])
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+    print_report(profile_imports(args.modules), args.top)
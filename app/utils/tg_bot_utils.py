@@ -1,6 +1,7 @@
 import asyncio
 import datetime
 import logging
+import time
 
 from aiogram import types
 from aiogram.dispatcher import FSMContext
@@ -17,8 +18,10 @@ logger = logging.getLogger(__name__)
 FORWARD_MESSAGE_FORMAT = "Forwarded message from {user_name}: {message}"
 DEFAULT_MESSAGE_FORMAT = "{message}"
 DOCUMENTS_DESCRIPTION_PROMPT = "\nDescription of documents provided by user: \n{documents_desc}"
+CURRENT_TIME_PROMPT = "Current date and time: {dt}"
 
 MAX_MESSAGE_LENGTH = 4096
+PROGRESS_UPDATE_INTERVAL = 2.0  # in seconds, Telegram limits messages edits
 
 
 class TypingBlock(object):
@@ -44,19 +47,46 @@ class TypingBlock(object):
             self.typing_task.cancel()
 
 
+class ProgressMessage(object):
+    """Edits a sent message with progress of a long operation, not more often than PROGRESS_UPDATE_INTERVAL"""
+
+    def __init__(self, message: Message, text_format: str):
+        self.message = message
+        self.text_format = text_format
+        self.last_update = time.monotonic()
+
+    async def update(self, done: int):
+        now = time.monotonic()
+        if now - self.last_update < PROGRESS_UPDATE_INTERVAL:
+            return
+        self.last_update = now
+        try:
+            await self.message.edit_text(self.text_format.format(done=done))
+        except BadRequest:  # message is not modified or deleted
+            pass
+
+
 def format_language_code(language_code: str):
     return language_code if language_code in ['ru', 'en'] else 'en'
 
 
-def format_system_prompt(tg_user: User, current_user_data: dict, system_prompt: str):
+def format_system_prompt_values(tg_user: User, current_user_data: dict) -> dict:
+    """
+    Values of the static prompt, they change only with the date or documents, so the provider's prompt cache hits.
+    The current time goes to the end of the request, see format_time_prompt.
+    """
     lc = format_language_code(tg_user.language_code)
-    system_prompt = system_prompt.format(user_name=tg_user.first_name,
-                                         user_lang=lc,
-                                         dt=datetime.datetime.now().strftime("%Y-%m-%d %H:%M"))
+    documents_desc = ""
     if current_user_data.get('documents'):
-        documents_desc = "\n".join(current_user_data.get('documents'))
-        system_prompt += DOCUMENTS_DESCRIPTION_PROMPT.format(documents_desc=documents_desc)
-    return system_prompt
+        documents_desc = DOCUMENTS_DESCRIPTION_PROMPT.format(documents_desc="\n".join(current_user_data.get('documents')))
+    return dict(user_name=tg_user.first_name,
+                user_lang=lc,
+                dt=datetime.datetime.now().strftime("%Y-%m-%d"),
+                documents_desc=documents_desc)
+
+
+def format_time_prompt():
+    return CURRENT_TIME_PROMPT.format(dt=datetime.datetime.now().strftime("%Y-%m-%d %H:%M"))
 
 
 async def no_access_message(tg_user: User, message):
@@ -72,7 +102,10 @@ async def no_access_message(tg_user: User, message):
 
 def session_auto_ended(tg_chat_id: int):
     from app.bot import tg_bot
+    from app.database.chroma_db_service import schedule_user_vectors_removal
     from app.database.entity_services import users_service
+
+    schedule_user_vectors_removal(int(tg_chat_id))
     with session_factory() as session:
         user = users_service.get_user_by_id(session, tg_chat_id)
         if user is not None: